@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for garmin-badges-updater.py
+
+Runs the full sync of the updater against a local mock of Garmin Connect and garminbadges.com,
+so the fetch strategies can be measured without touching the real services.
+
+The mock serves:
+/badge-service/badge/earned
+/badge-service/badge/detail/v2/{badgeId}
+/badgechallenge-service/badgeChallenge/{uuid}
+/user/updatekey, /user/earned and /user/challenges
+
+Every strategy runs in its own process so peak memory isn't shared between runs.
+For each run the wall time, requests/sec, peak RSS and CPU time are reported.
+
+To run the benchmark run:
+python garmin-badges-benchmark.py --badges=10,100,1000 --latency=0.02
+
+To compare the transform of the badges to the Garmin Badges JSON with the transform of v1.4.0 run:
+python garmin-badges-benchmark.py --transform --badges=1000,10000,100000
+
+To measure the cold start of the scripts with python -X importtime run:
+python garmin-badges-benchmark.py --import-time --budget-ms=300
+
+To save the responses of a run as an archive and run the strategies against it without any server run:
+python garmin-badges-benchmark.py --badges=1000 --strategies=threads --record=sync.jsonl.gz
+python garmin-badges-benchmark.py --replay=sync.jsonl.gz --strategies=threads,pipeline
+
+"""
+
+import sys
+import os
+import io
+import json
+import time
+import random
+import uuid
+import tempfile
+import threading
+import subprocess
+import contextlib
+import importlib.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+	import resource
+except ImportError:
+	# Not available on Windows, peak RSS is reported as 0 there
+	resource = None
+
+updaterFileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), "garmin-badges-updater.py")
+
+def main():
+	if getArgumentValue("--run-strategy"):
+		runStrategyInThisProcess()
+		return
+	if "--help" in sys.argv:
+		printHelp()
+		return
+	if "--transform" in sys.argv:
+		runTransformBenchmark()
+		return
+	if "--import-time" in sys.argv:
+		runImportTimeBenchmark()
+		return
+
+	badgeCounts = [int(count) for count in getArgumentValue("--badges", "10,100,1000").split(",")]
+	strategies = getArgumentValue("--strategies", "threads,async").split(",")
+	workers = int(getArgumentValue("--workers", 10))
+	recordFileName = getArgumentValue("--record")
+	replayFileName = getArgumentValue("--replay")
+	if (recordFileName or replayFileName) and "async" in strategies:
+		# aiohttp doesn't go through the requests sessions the archive is attached to
+		print("The async strategy can't be recorded or replayed, it is skipped")
+		strategies = [strategy for strategy in strategies if strategy != "async"]
+	if replayFileName:
+		runReplayBenchmark(replayFileName, strategies, workers)
+		return
+	latency = float(getArgumentValue("--latency", 0.02))
+	errorRate = float(getArgumentValue("--error-rate", 0))
+	throttleRate = float(getArgumentValue("--throttle-rate", 0))
+	challengeRate = float(getArgumentValue("--challenge-rate", 0.2))
+	uploadLatency = float(getArgumentValue("--upload-latency", 0))
+
+	results = []
+	for badgeCount in badgeCounts:
+		mockServer = startMockServer(badgeCount, latency, errorRate, challengeRate, throttleRate, uploadLatency)
+		mockUrl = "http://127.0.0.1:" + str(mockServer.server_address[1])
+		for strategy in strategies:
+			mockServer.requestCount = 0
+			# Only the first run is recorded
+			extraArguments = ["--record=" + recordFileName] if recordFileName and not results else []
+			result = runStrategyInSubprocess(strategy, mockUrl, workers, extraArguments)
+			result.update({
+				"strategy": strategy,
+				"badges": badgeCount,
+				"requests": mockServer.requestCount,
+				"requestsPerSecond": mockServer.requestCount / result["wallTime"] if result["wallTime"] else 0
+			})
+			results.append(result)
+			printResult(result)
+		mockServer.shutdown()
+
+	jsonFileName = getArgumentValue("--json")
+	if jsonFileName:
+		with open(jsonFileName, 'w') as f:
+			json.dump(results, f, indent=2)
+
+def runReplayBenchmark(replayFileName, strategies, workers):
+	results = []
+	for strategy in strategies:
+		result = runStrategyInSubprocess(strategy, None, workers, ["--replay=" + replayFileName])
+		result.update({
+			"strategy": strategy,
+			"badges": result["earned"],
+			"requests": result["replayedRequests"],
+			"requestsPerSecond": result["replayedRequests"] / result["wallTime"] if result["wallTime"] else 0
+		})
+		results.append(result)
+		printResult(result)
+
+	jsonFileName = getArgumentValue("--json")
+	if jsonFileName:
+		with open(jsonFileName, 'w') as f:
+			json.dump(results, f, indent=2)
+
+def getArgumentValue(name, default=None):
+	# Options with a value are passed as --name=value
+	for argument in sys.argv:
+		if argument.startswith(name + "="):
+			return argument[len(name) + 1:]
+	return default
+
+def loadUpdater():
+	spec = importlib.util.spec_from_file_location("garmin_badges_updater", updaterFileName)
+	updater = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(updater)
+	return updater
+
+def startMockServer(badgeCount, latency, errorRate, challengeRate, throttleRate=0, uploadLatency=0):
+	earnedBadges = [createMockBadge(badgeId) for badgeId in range(1, badgeCount + 1)]
+	challengeUuids = {badge["badgeId"]: uuid.uuid4().hex for badge in earnedBadges if random.random() < challengeRate}
+
+	class MockHandler(BaseHTTPRequestHandler):
+		# HTTP/1.1 keeps connections alive like the real services
+		protocol_version = "HTTP/1.1"
+
+		def do_GET(self):
+			self.server.countRequest()
+			time.sleep(latency)
+			if self.path == "/badge-service/badge/earned":
+				return self.sendJson(200, earnedBadges)
+			# Only the detail requests fail, a failing earned list would stop the whole sync
+			if random.random() < errorRate:
+				return self.sendJson(500, {"error": "Mock error"})
+			if random.random() < throttleRate:
+				return self.sendJson(429, {"error": "Too many requests"}, {"Retry-After": "1"})
+			if self.path.startswith("/badge-service/badge/detail/v2/"):
+				badgeId = int(self.path.rsplit("/", 1)[1])
+				return self.sendJson(200, createMockBadge(badgeId))
+			if self.path.startswith("/badgechallenge-service/badgeChallenge/"):
+				return self.sendJson(200, {"joinDateLocal": "2024-01-01T00:00:00.0"})
+			self.sendJson(404, {})
+
+		def do_POST(self):
+			self.server.countRequest()
+			body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+			time.sleep(latency)
+			if self.path.endswith("/user/updatekey"):
+				return self.sendJson(200, {"id": 1, "update_key": "benchmark", "python_script_version": self.server.version})
+			if body.get("update_key") not in (None, "benchmark"):
+				return self.sendJson(401, {"error": "Invalid update key"})
+			if self.path.endswith("/user/earned"):
+				return self.sendJson(200, [{"badgeNo": badge["badgeId"], "badgeUuid": challengeUuids.get(badge["badgeId"])} for badge in body["badges"]])
+			if self.path.endswith("/user/challenges"):
+				time.sleep(uploadLatency * len(body["badges"]))
+				return self.sendJson(200, {"badges": len(body["badges"])})
+			self.sendJson(404, {})
+
+		def sendJson(self, status, data, headers={}):
+			body = json.dumps(data).encode("utf-8")
+			self.send_response(status)
+			self.send_header("Content-Type", "application/json")
+			for name, value in headers.items():
+				self.send_header(name, value)
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	mockServer = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+	mockServer.daemon_threads = True
+	mockServer.version = loadUpdater().version
+	mockServer.requestCount = 0
+	countLock = threading.Lock()
+	def countRequest():
+		with countLock:
+			mockServer.requestCount += 1
+	mockServer.countRequest = countRequest
+	threading.Thread(target=mockServer.serve_forever, daemon=True).start()
+	return mockServer
+
+def createMockBadge(badgeId):
+	return {
+		"badgeId": badgeId,
+		"badgeName": "Badge " + str(badgeId),
+		"badgeEarnedNumber": 1,
+		"badgeEarnedDate": "2024-01-01T00:00:00.0",
+		"badgeProgressValue": badgeId * 10,
+		"badgeTargetValue": 1000,
+		"badgeUnitId": badgeId % 8,
+		"userJoined": badgeId % 2 == 0
+	}
+
+def runStrategyInSubprocess(strategy, mockUrl, workers, extraArguments=[]):
+	command = [sys.executable, os.path.abspath(__file__), "--run-strategy=" + strategy, "--workers=" + str(workers)] + extraArguments
+	if mockUrl:
+		command.append("--mock-url=" + mockUrl)
+	output = subprocess.run(command, capture_output=True, text=True)
+	if output.returncode != 0:
+		print(output.stderr)
+		raise Exception(f"Strategy {strategy} failed")
+	return json.loads(output.stdout.strip().splitlines()[-1])
+
+def runStrategyInThisProcess():
+	strategy = getArgumentValue("--run-strategy")
+	mockUrl = getArgumentValue("--mock-url")
+
+	updater = loadUpdater()
+	updater.maxWorkers = int(getArgumentValue("--workers", 10))
+	updater.asyncMode = strategy == "async"
+	updater.pipelineMode = strategy == "pipeline"
+	updater.badgeCacheMode = "off"
+	updater.historyMode = False
+	updater.versionChecked = True
+	if getArgumentValue("--record"):
+		updater.recordArchive = updater.HttpArchive(getArgumentValue("--record"), "record")
+	if getArgumentValue("--replay"):
+		# No mock server, the updater gets all responses from the archive
+		updater.replayArchive = updater.HttpArchive(getArgumentValue("--replay"), "replay")
+		client = updater.createReplayClient()
+	else:
+		updater.garminBadgesApiUrl = mockUrl
+		client = MockConnectClient(mockUrl, updater.createConnectAdapter(1, updater.maxWorkersLimit))
+
+	account = updater.SyncAccount("benchmark", client, tempfile.mkdtemp() + "/", None, "benchmark", "benchmark@example.com")
+	account.connectApiUrl = mockUrl
+
+	startWallTime = time.perf_counter()
+	startCpuTime = time.process_time()
+	with contextlib.redirect_stdout(io.StringIO()):
+		syncResult = updater.syncAccount(account)
+	result = {
+		"wallTime": time.perf_counter() - startWallTime,
+		"cpuTime": time.process_time() - startCpuTime,
+		"peakRssMb": getPeakRssMb(),
+		"failed": syncResult["failed"],
+		"earned": syncResult["earned"],
+		"connectLimiter": account.limiter.getStats()
+	}
+	if updater.recordArchive:
+		updater.recordArchive.close()
+	if updater.replayArchive:
+		result["replayedRequests"] = updater.replayArchive.getServedCount()
+	print(json.dumps(result))
+
+def getPeakRssMb():
+	if not resource:
+		return 0
+	peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports kilobytes, macOS bytes
+	return peakRss / (1024 * 1024) if sys.platform == "darwin" else peakRss / 1024
+
+class MockOAuth2Token:
+	expired = False
+	expires_at = time.time() + 24 * 60 * 60
+
+	def __str__(self):
+		return "Bearer benchmark"
+
+class MockConnectClient:
+	# Stands in for a garth client, but sends the requests to the mock server with the adapter of the updater
+	def __init__(self, mockUrl, adapter):
+		import requests
+		self.mockUrl = mockUrl
+		self.domain = "garmin.com"
+		self.oauth2_token = MockOAuth2Token()
+		self.sess = requests.Session()
+		self.sess.mount("http://", adapter)
+
+	def request(self, method, subdomain, path, api=False, headers={}, **kwargs):
+		response = self.sess.request(method, self.mockUrl + path, headers=headers, **kwargs)
+		response.raise_for_status()
+		return response
+
+	def connectapi(self, path, method="GET", **kwargs):
+		response = self.request(method, "connectapi", path, api=True, **kwargs)
+		return None if response.status_code == 204 else response.json()
+
+def runTransformBenchmark():
+	updater = loadUpdater()
+	badgeCounts = [int(count) for count in getArgumentValue("--badges", "1000,10000,100000").split(",")]
+	repeats = int(getArgumentValue("--repeats", 5))
+
+	results = []
+	for badgeCount in badgeCounts:
+		garminBadges = [createMockBadge(badgeId) for badgeId in range(1, badgeCount + 1)]
+		# The updater parses the Garmin Connect json into Badge records first
+		parseBadges = lambda: [updater.Badge.fromConnect(badge) for badge in garminBadges]
+		if createLegacyGarminBadges(garminBadges, updater.version) != updater.createGarminBadges(parseBadges()):
+			raise Exception("The transform doesn't match the transform of v1.4.0")
+		result = {
+			"badges": badgeCount,
+			"legacyTransform": timeCall(lambda: createLegacyGarminBadges(garminBadges), repeats),
+			"transform": timeCall(lambda: updater.createGarminBadges(parseBadges()), repeats),
+			"legacySerialize": timeCall(lambda: serializeLegacyGarminBadges(garminBadges), repeats),
+			"serialize": timeCall(lambda: updater.serializeGarminBadgesJson(parseBadges(), "benchmark", False, {"raw": 0, "sent": 0}), repeats)
+		}
+		results.append(result)
+		print(f"{badgeCount:>7} badges  transform {result['legacyTransform'] * 1000:>8.1f} ms -> {result['transform'] * 1000:>8.1f} ms  transform + serialize {result['legacySerialize'] * 1000:>8.1f} ms -> {result['serialize'] * 1000:>8.1f} ms  ({result['legacySerialize'] / result['serialize']:.2f}x)")
+
+	jsonFileName = getArgumentValue("--json")
+	if jsonFileName:
+		with open(jsonFileName, 'w') as f:
+			json.dump(results, f, indent=2)
+
+def timeCall(call, repeats):
+	# Best time of the repeats
+	times = []
+	for _ in range(repeats):
+		startTime = time.perf_counter()
+		call()
+		times.append(time.perf_counter() - startTime)
+	return min(times)
+
+def runImportTimeBenchmark():
+	# Cold start of the invocations cron and health checks use. The challenges script is only imported,
+	# running it would start a browser.
+	scriptDir = os.path.dirname(os.path.abspath(__file__))
+	challengesFileName = os.path.join(scriptDir, "garmin-connect-challenges.py")
+	importChallenges = f"import importlib.util; spec = importlib.util.spec_from_file_location('challenges', {challengesFileName!r}); spec.loader.exec_module(importlib.util.module_from_spec(spec))"
+	invocations = [
+		("updater --version", [updaterFileName, "--version"]),
+		("updater --help", [updaterFileName, "--help"]),
+		("challenges import", ["-c", importChallenges])
+	]
+	repeats = int(getArgumentValue("--repeats", 5))
+	budgetMs = float(getArgumentValue("--budget-ms", 0))
+
+	results = []
+	for name, arguments in invocations:
+		result = None
+		for _ in range(repeats):
+			run = runWithImportTime(arguments)
+			if not result or run["wallTime"] < result["wallTime"]:
+				result = run
+		result["invocation"] = name
+		results.append(result)
+		slowestImports = ", ".join(f"{module} {seconds * 1000:.0f} ms" for module, seconds in result["slowestImports"])
+		print(f"{name:<20} {result['wallTime'] * 1000:>7.0f} ms wall  {result['importTime'] * 1000:>7.0f} ms imports  slowest: {slowestImports}")
+
+	jsonFileName = getArgumentValue("--json")
+	if jsonFileName:
+		with open(jsonFileName, 'w') as f:
+			json.dump(results, f, indent=2)
+	if budgetMs and any(result["wallTime"] * 1000 > budgetMs for result in results):
+		print(f"Cold start is over the budget of {budgetMs:.0f} ms")
+		sys.exit(1)
+
+def runWithImportTime(arguments):
+	startTime = time.perf_counter()
+	output = subprocess.run([sys.executable, "-X", "importtime"] + arguments, capture_output=True, text=True)
+	wallTime = time.perf_counter() - startTime
+	if output.returncode != 0:
+		print(output.stderr)
+		raise Exception("Failed to run " + " ".join(arguments))
+
+	# Lines are "import time: self [us] | cumulative | imported package", nested imports are indented
+	topLevelImports = {}
+	for line in output.stderr.splitlines():
+		if not line.startswith("import time:") or line.startswith("import time: self"):
+			continue
+		selfTime, cumulativeTime, module = line[len("import time:"):].split("|")
+		if not module.startswith("  "):
+			topLevelImports[module.strip()] = int(cumulativeTime) / 1000000
+	slowestImports = sorted(topLevelImports.items(), key=lambda item: item[1], reverse=True)[:5]
+	return {"wallTime": wallTime, "importTime": sum(topLevelImports.values()), "slowestImports": slowestImports}
+
+def createLegacyGarminBadges(garminBadges, version="1.4.0"):
+	# The transform of v1.4.0, with the unit table built on every call and a lookup per field
+	joinDateLocal = None;
+
+	unitArray = {
+		1: "mi_km",
+		2: "ft_m",
+		3: "activities",
+		4: "days",
+		5: "steps",
+		6: "mi",
+		7: "seconds"
+	}
+
+	newBadges = []
+	for badge in garminBadges:
+		if not badge:
+			continue
+		badgeUnit = ""
+		try:
+			badgeUnit = unitArray[badge["badgeUnitId"]]
+		except KeyError:
+			badgeUnit = ""
+
+		if "joinDateLocal" in badge:
+			joinDateLocal = badge["joinDateLocal"]
+
+		newBadges.append({
+			"badgeId": badge["badgeId"],
+			"badgeName": badge["badgeName"],
+			"count": badge["badgeEarnedNumber"],
+			"earned_date": badge["badgeEarnedDate"],
+			"badgeProgressValue": badge["badgeProgressValue"],
+			"badgeTargetValue": badge["badgeTargetValue"],
+			"badgeUnit": badgeUnit,
+			"userJoined": True if badge["userJoined"] else False,
+			"joinDateLocal": joinDateLocal,
+			"createdBy": "Python script v." + version
+		})
+	return newBadges
+
+def serializeLegacyGarminBadges(garminBadges):
+	# v1.4.0 serialized the upload one json.dumps call per badge
+	parts = ['{"update_key": "benchmark", "badges": [']
+	for index, newBadge in enumerate(createLegacyGarminBadges(garminBadges)):
+		parts.append(("" if index == 0 else ", ") + json.dumps(newBadge))
+	parts.append("]}")
+	return "".join(parts).encode("utf-8")
+
+def printResult(result):
+	print(f"{result['strategy']:<10} {result['badges']:>6} badges  {result['wallTime']:>8.2f} s  {result['requestsPerSecond']:>8.1f} req/s  {result['cpuTime']:>7.2f} s CPU  {result['peakRssMb']:>7.1f} MB peak RSS  {result['failed']} failed  limit {result['connectLimiter']['limit']}")
+
+def printHelp():
+	print("Usage: garmin-badges-benchmark.py [options]\n")
+	print("Options and arguments:")
+	print("   --badges=N,N      : Number of badges in each run (default 10,100,1000, with --transform 1000,10000,100000).")
+	print("   --budget-ms=MS    : With --import-time, exit with an error when a cold start takes longer.")
+	print("   --challenge-rate=R : Part of the badges that are challenges (default 0.2).")
+	print("   --error-rate=R    : Part of the badge detail requests that fail with 500 (default 0).")
+	print("   --help            : This information about options and arguments.")
+	print("   --import-time     : Measure the cold start of the scripts with python -X importtime.")
+	print("   --json=FILE       : Save the results as JSON.")
+	print("   --latency=SECONDS : Latency of every mock request (default 0.02).")
+	print("   --record=FILE     : Save the responses of the first run as an archive for --replay.")
+	print("   --replay=FILE     : Run the strategies against an archive of the updater or of --record, without mock server.")
+	print("   --repeats=N       : Number of runs of each transform or cold start, the best time is reported (default 5).")
+	print("   --strategies=S,S  : Fetch strategies to run: threads, async, pipeline (default threads,async).")
+	print("   --transform       : Compare the transform of the badges with the transform of v1.4.0.")
+	print("   --throttle-rate=R : Part of the badge detail requests that are throttled with 429 and Retry-After (default 0).")
+	print("   --upload-latency=SECONDS : Extra latency per badge of the badge details upload (default 0).")
+	print("   --workers=N       : Number of parallel Garmin Connect requests to start with (default 10).")
+
+
+if __name__ == "__main__":
+	main()
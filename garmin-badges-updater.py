@@ -20,6 +20,9 @@ The python command can be different for different installs: python3, python or p
 Run this before you run the script to install the dependencies:
 python -m pip install garth
 
+The --async option also needs aiohttp:
+python -m pip install aiohttp
+
 To run this script run:
 python garminbadges-updater.py
 
@@ -28,85 +31,1234 @@ To remove all credentials and start over delete the folder ~/.garth and run the
 
 """
 
-import garth
 from getpass import getpass
-import requests
 import sys
 import json
 import os
 import logging
-from threading import Thread
+import concurrent.futures
 import threading
+import queue
 from pathlib import Path
-import webbrowser
-#import time
+import time
+import random
+import zlib
+import codecs
+import re
+import hashlib
+import contextlib
+import itertools
+import operator
 
 userId = 0
-updateKey = ""
-pythonVersion = ""
 debugMode = False
+maxWorkers = 10
+maxWorkersLimit = 30
+connectRetries = 3
+requestTimeout = 30
+asyncMode = False
+incrementalMode = False
+badgeCacheMode = "use"
+# The fingerprint check catches changed earned badges, the TTL only bounds how old the other fields can get.
+# Badges without a fingerprint in the earned list are revalidated with their ETag on every run.
+# It's well above the daily cron period, so the next night's run doesn't depend on a few seconds of drift.
+badgeCacheTtl = 7 * 24 * 60 * 60
+badgeCacheMaxEntries = 5000
+sessionTtl = 24 * 60 * 60
+historyMode = True
+historyFileName = None
+recordArchive = None
+replayArchive = None
+dryRunMode = False
+dryRunDir = None
+tokenRefreshMargin = 10 * 60
+garthDir = "~/.garth"
+configDir = "~/.garminbadges/"
+batchWorkers = 4
+connectTimeout = 10
+readTimeout = 60
+uploadRetries = 3
+gzipUploads = False
+garminBadgesApiUrl = "https://garminbadges.com/api/index.php"
+uploadChunkSize = 0
+uploadWorkers = 2
+pipelineMode = False
+pipelineBatchSize = 50
+daemonInterval = 60 * 60
+daemonJitter = None
+daemonHttpPort = 8787
+watchMode = False
+pollInterval = 5 * 60
+maxPollInterval = 60 * 60
+versionChecked = False
+garminBadgesSession = None
+connectAdapter = None
+sessionLock = threading.Lock()
 
-def main():
-	#start_time = time.time()
+class SyncAccount:
+	# Session, folders and garminbadges.com info of one account. Batch runs sync several at the same time.
+	def __init__(self, name, client, configDir, garthDir, gbUsername, gbEmail):
+		self.name = name
+		self.client = client
+		useHttpArchive(client.sess)
+		self.configDir = configDir
+		self.garthDir = garthDir
+		self.gbUsername = gbUsername
+		self.gbEmail = gbEmail
+		self.userId = 0
+		self.updateKey = ""
+		self.pythonVersion = ""
+		# Overrides https://connectapi.<domain> for the --async requests, the benchmark points it to a mock server
+		self.connectApiUrl = None
+		self.metrics = SyncMetrics()
+		self.limiter = AdaptiveLimiter(maxWorkers, maxWorkersLimit)
+		self.coalescer = RequestCoalescer()
+
+	def log(self, message):
+		if self.name:
+			print(f"[{self.name}] {message}")
+		else:
+			print(message)
+
+class AdaptiveLimiter:
+	# Limits the number of Garmin Connect requests in flight with AIMD: the limit grows by about one request
+	# per round of fast successful requests, and is halved on 429, 5xx and connection errors. It is lowered
+	# by 10% when requests get a lot slower than the fastest one. A Retry-After header pauses all requests.
+	latencyFactor = 3
+
+	def __init__(self, initialLimit, maxLimit):
+		self.condition = threading.Condition()
+		self.limit = float(min(initialLimit, maxLimit))
+		self.maxLimit = maxLimit
+		self.inFlight = 0
+		self.pausedUntil = 0
+		self.minLatency = None
+		self.lastDecrease = 0
+		self.throttled = 0
+		self.lowestLimit = self.limit
+		self.highestLimit = self.limit
+		self.releasedEvent = None
+
+	def tryAcquire(self):
+		# Returns 0 when a request may start, otherwise the number of seconds to wait (None: until a request is released)
+		pause = self.pausedUntil - time.time()
+		if pause > 0:
+			return pause
+		if self.inFlight >= int(self.limit):
+			return None
+		self.inFlight += 1
+		return 0
+
+	def acquire(self):
+		with self.condition:
+			while True:
+				wait = self.tryAcquire()
+				if wait == 0:
+					return
+				self.condition.wait(wait)
+
+	async def acquireAsync(self):
+		# releasedEvent belongs to the running event loop, see fetchBadgesFromGarminAsync
+		import asyncio
+		while True:
+			with self.condition:
+				wait = self.tryAcquire()
+			if wait == 0:
+				return
+			self.releasedEvent.clear()
+			try:
+				await asyncio.wait_for(self.releasedEvent.wait(), wait)
+			except asyncio.TimeoutError:
+				pass
+
+	def release(self, seconds, status, retryAfter=None):
+		with self.condition:
+			self.inFlight -= 1
+			now = time.time()
+			if status is None:
+				# Failed for another reason than the load on Garmin Connect
+				pass
+			elif isThrottledStatus(status):
+				self.throttled += 1
+				self.decrease(0.5, now)
+				if retryAfter:
+					self.pausedUntil = max(self.pausedUntil, now + retryAfter)
+			else:
+				self.minLatency = seconds if self.minLatency is None else min(self.minLatency, seconds)
+				if seconds > self.latencyFactor * max(self.minLatency, 0.05):
+					self.decrease(0.9, now)
+				else:
+					self.limit = min(self.maxLimit, self.limit + 1 / self.limit)
+			self.highestLimit = max(self.highestLimit, self.limit)
+			self.condition.notify_all()
+		if self.releasedEvent:
+			self.releasedEvent.set()
+
+	def decrease(self, factor, now):
+		# Lower the limit only once per round trip, all requests of one overloaded round fail together
+		if now - self.lastDecrease < (self.minLatency or 0):
+			return
+		self.lastDecrease = now
+		self.limit = max(1.0, self.limit * factor)
+		self.lowestLimit = min(self.lowestLimit, self.limit)
+
+	def getStats(self):
+		with self.condition:
+			return {"limit": int(self.limit), "lowestLimit": int(self.lowestLimit), "highestLimit": int(self.highestLimit), "throttled": self.throttled}
+
+class RequestCoalescer:
+	# Identical Garmin Connect requests of an account share one round trip and one result. The key is the request path.
+	# With keepResult the result is also reused by later requests in the sync, failed requests are always tried again.
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.futures = {}
+		self.tasks = {}
+
+	def call(self, key, call, keepResult=False):
+		# Runs the call in this thread, unless the same request is already running
+		with self.lock:
+			future = self.futures.get(key)
+			isOwner = future is None or hasFailed(future)
+			if isOwner:
+				future = concurrent.futures.Future()
+				self.futures[key] = future
+		if isOwner:
+			try:
+				future.set_result(call())
+			except BaseException as e:
+				# Also Ctrl+C, the requests waiting for this one must not hang
+				future.set_exception(e)
+			finally:
+				with self.lock:
+					if (not keepResult or hasFailed(future)) and self.futures.get(key) is future:
+						del self.futures[key]
+		return future.result()
+
+	def submit(self, executor, key, call):
+		# Runs the call on the executor and keeps the result
+		with self.lock:
+			future = self.futures.get(key)
+			if future is None or hasFailed(future):
+				future = executor.submit(call)
+				self.futures[key] = future
+			return future
+
+	async def callAsync(self, key, makeCoroutine, keepResult=False):
+		# Same as call for the asyncio fetch, the tasks belong to the running event loop
+		import asyncio
+		task = self.tasks.get(key)
+		if task is None or hasFailed(task):
+			task = asyncio.ensure_future(makeCoroutine())
+			self.tasks[key] = task
+			if not keepResult:
+				task.add_done_callback(lambda task: self.forgetTask(key, task))
+		return await asyncio.shield(task)
+
+	def forgetTask(self, key, task):
+		if self.tasks.get(key) is task:
+			del self.tasks[key]
+
+def hasFailed(future):
+	return future.done() and (future.cancelled() or future.exception() is not None)
+
+class SyncDaemon:
+	# Runs syncs one at a time, every interval seconds plus a random jitter so several installations don't sync
+	# at the same moment. Triggers while a sync is running are coalesced into one extra sync after it.
+	# The interval and the jitter are functions, so --watch can change them after every poll.
+	def __init__(self, runSync, getInterval, getJitter):
+		self.runSync = runSync
+		self.getInterval = getInterval
+		self.getJitter = getJitter
+		self.condition = threading.Condition()
+		self.triggered = True
+		self.running = False
+		self.runs = 0
+		self.nextRunAt = time.time()
+		self.lastRunAt = None
+		self.lastResults = []
+		self.lastError = None
+
+	def trigger(self):
+		with self.condition:
+			self.triggered = True
+			self.condition.notify_all()
+			return self.running
+
+	def run(self):
+		while True:
+			with self.condition:
+				while not self.triggered and time.time() < self.nextRunAt:
+					self.condition.wait(self.nextRunAt - time.time())
+				self.triggered = False
+				self.running = True
+				self.lastRunAt = time.time()
+			try:
+				results = self.runSync()
+				error = None
+			except Exception as e:
+				# A failing sync doesn't stop the daemon, the error is shown in /status
+				print(f"✗ Sync failed: {e}")
+				results = []
+				error = str(e) or type(e).__name__
+			with self.condition:
+				self.running = False
+				self.runs += 1
+				self.lastResults = results
+				self.lastError = error
+				self.nextRunAt = time.time() + self.getInterval() + random.uniform(0, self.getJitter())
+
+	def getStatus(self):
+		with self.condition:
+			return {
+				"version": version,
+				"running": self.running,
+				"syncQueued": self.triggered,
+				"runs": self.runs,
+				"lastRunAt": self.lastRunAt,
+				"nextRunAt": self.nextRunAt,
+				"error": self.lastError,
+				"accounts": [{key: result[key] for key in ("account", "status", "earned", "details", "failed", "seconds", "error")} for result in self.lastResults]
+			}
+
+	def startHttpServer(self, port):
+		# Only listens on localhost, there is no authentication
+		from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+		daemon = self
+
+		class DaemonRequestHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path == "/status":
+					return self.sendResponse(200, json.dumps(daemon.getStatus(), indent=2), "application/json")
+				if self.path == "/metrics":
+					return self.sendResponse(200, createPrometheusMetrics(daemon.lastResults), "text/plain; version=0.0.4")
+				if self.path == "/metrics.json":
+					return self.sendResponse(200, json.dumps(createMetricsReport(daemon.lastResults), indent=2), "application/json")
+				self.sendResponse(404, json.dumps({"error": "Not found"}), "application/json")
+
+			def do_POST(self):
+				if self.path == "/sync":
+					running = daemon.trigger()
+					return self.sendResponse(202, json.dumps({"queued": True, "running": running}), "application/json")
+				self.sendResponse(404, json.dumps({"error": "Not found"}), "application/json")
+
+			def sendResponse(self, status, body, contentType):
+				body = body.encode("utf-8")
+				self.send_response(status)
+				self.send_header("Content-Type", contentType)
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				if(debugMode):
+					super().log_message(format, *args)
+
+		httpServer = ThreadingHTTPServer(("127.0.0.1", port), DaemonRequestHandler)
+		httpServer.daemon_threads = True
+		threading.Thread(target=httpServer.serve_forever, daemon=True).start()
+		return httpServer
+
+class IdleBackoff:
+	# The poll interval of --watch doubles after every poll without changes, up to maxInterval, and goes back
+	# to minInterval after a sync. Failed polls back off as well, so Connect isn't asked again right away.
+	def __init__(self, minInterval, maxInterval):
+		self.minInterval = minInterval
+		self.maxInterval = maxInterval
+		self.interval = minInterval
+
+	def update(self, results):
+		if any(result["status"] == "synced" for result in results):
+			self.interval = self.minInterval
+		else:
+			self.interval = min(self.interval * 2, self.maxInterval)
+		return results
+
+	def getInterval(self):
+		return self.interval
+
+class SyncMetrics:
+	# Phase durations and Connect request latencies of one account sync, exported with --metrics-json and --metrics-prom
+	latencyBuckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.startTime = time.time()
+		self.phases = {}
+		self.requests = {}
+		self.limiter = None
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		phaseStart = time.perf_counter()
+		ok = False
+		try:
+			yield
+			ok = True
+		finally:
+			with self.lock:
+				self.phases[name] = {"seconds": time.perf_counter() - phaseStart, "ok": ok}
+
+	def recordRequest(self, path, seconds, ok):
+		# Badge numbers and uuids in the path are replaced, so all detail requests end up in one histogram
+		endpoint = "/".join("{id}" if part.isdigit() or len(part) >= 16 else part for part in path.split("/"))
+		with self.lock:
+			request = self.requests.setdefault(endpoint, {"count": 0, "errors": 0, "seconds": 0.0, "buckets": [0] * len(self.latencyBuckets)})
+			request["count"] += 1
+			request["seconds"] += seconds
+			if not ok:
+				request["errors"] += 1
+			for index, bucket in enumerate(self.latencyBuckets):
+				if seconds <= bucket:
+					request["buckets"][index] += 1
+
+	@contextlib.contextmanager
+	def request(self, path):
+		requestStart = time.perf_counter()
+		ok = False
+		try:
+			yield
+			ok = True
+		finally:
+			self.recordRequest(path, time.perf_counter() - requestStart, ok)
+
+class HttpArchive:
+	# Responses of Garmin Connect and garminbadges.com, one JSON line per response in a gzip file.
+	# --record writes every response, --replay serves the responses of each endpoint again in the recorded order.
+	def __init__(self, fileName, mode):
+		import gzip
+		self.fileName = os.path.expanduser(fileName)
+		self.lock = threading.Lock()
+		self.responses = {}
+		self.served = {}
+		self.file = None
+		if mode == "record":
+			self.file = gzip.open(self.fileName, "wt", encoding="utf-8")
+			import atexit
+			atexit.register(self.close)
+		else:
+			with gzip.open(self.fileName, "rt", encoding="utf-8") as f:
+				for line in f:
+					entry = json.loads(line)
+					self.responses.setdefault(entry["key"], []).append(entry)
+
+	def record(self, key, response):
+		entry = {"key": key, "status": response.status_code, "reason": response.reason,
+			"headers": {name: value for name, value in response.headers.items() if name.lower() in ("content-type", "retry-after")}}
+		try:
+			entry["body"] = response.content.decode("utf-8")
+		except UnicodeDecodeError:
+			import base64
+			entry["bodyBase64"] = base64.b64encode(response.content).decode("ascii")
+		line = json.dumps(entry) + "\n"
+		with self.lock:
+			self.file.write(line)
+
+	def replay(self, key):
+		# After the last recorded response of an endpoint, that response is served again
+		with self.lock:
+			entries = self.responses.get(key)
+			if not entries:
+				raise Exception(f"No response for {key} in {self.fileName}")
+			index = self.served.get(key, 0)
+			self.served[key] = index + 1
+			return entries[min(index, len(entries) - 1)]
+
+	def getServedCount(self):
+		with self.lock:
+			return sum(self.served.values())
+
+	def close(self):
+		with self.lock:
+			if self.file:
+				self.file.close()
+				self.file = None
+
+class RecordingAdapter:
+	# Sends the requests with the adapter it replaces and writes the responses to the --record archive
+	def __init__(self, archive, adapter):
+		self.archive = archive
+		self.adapter = adapter
+
+	def send(self, request, **kwargs):
+		response = self.adapter.send(request, **kwargs)
+		key = getHttpArchiveKey(request.method, request.url)
+		# garth refreshes its tokens through this adapter too, the OAuth answers hold them in plain text
+		if not key.split(" ", 1)[1].startswith(("/oauth-service/", "/sso/")):
+			self.archive.record(key, response)
+		return response
+
+	def close(self):
+		self.adapter.close()
+
+class ReplayAdapter:
+	# Answers the requests from the --replay archive, without network
+	def __init__(self, archive):
+		self.archive = archive
+
+	def send(self, request, **kwargs):
+		from requests.models import Response
+		from requests.structures import CaseInsensitiveDict
+		from requests.utils import get_encoding_from_headers
+		entry = self.archive.replay(getHttpArchiveKey(request.method, request.url))
+		response = Response()
+		response.status_code = entry["status"]
+		response.reason = entry.get("reason") or ""
+		response.headers = CaseInsensitiveDict(entry["headers"])
+		response.encoding = get_encoding_from_headers(response.headers)
+		if "bodyBase64" in entry:
+			import base64
+			response._content = base64.b64decode(entry["bodyBase64"])
+		else:
+			response._content = entry["body"].encode("utf-8")
+		response._content_consumed = True
+		response.url = request.url
+		response.request = request
+		return response
+
+	def close(self):
+		pass
+
+class DryRunAdapter:
+	# --dry-run: builds the garminbadges.com payloads but answers the requests itself. Without the server
+	# every earned badge is fetched, as a badge without challenge info.
+	def __init__(self, payloadDir):
+		self.payloadDir = os.path.expanduser(payloadDir) if payloadDir else None
+		self.lock = threading.Lock()
+		self.count = 0
+		if self.payloadDir:
+			Path(self.payloadDir).mkdir(parents=True, exist_ok=True)
+
+	def send(self, request, **kwargs):
+		from requests.models import Response
+		from requests.structures import CaseInsensitiveDict
+		body = request.body or b""
+		if isinstance(body, str):
+			body = body.encode("utf-8")
+		if request.headers.get("Content-Encoding") == "gzip":
+			body = zlib.decompress(body, wbits=31)
+		endpoint = getHttpArchiveKey(request.method, request.url).split(" ", 1)[1]
+		payload = json.loads(body) if body else {}
+		with self.lock:
+			self.count += 1
+			count = self.count
+		print(f"Dry run: {request.method} {endpoint}, {len(body)} bytes" + (f", {len(payload['badges'])} badges" if "badges" in payload else ""))
+		if self.payloadDir:
+			with open(os.path.join(self.payloadDir, f"{count:03d}-{endpoint.strip('/').replace('/', '-')}.json"), 'wb') as f:
+				f.write(body)
+
+		if endpoint.endswith("/user/updatekey"):
+			answer = {"id": 0, "update_key": "dry-run", "python_script_version": version}
+		elif endpoint.endswith("/user/earned"):
+			answer = [{"badgeNo": badge["badgeId"], "badgeUuid": None} for badge in payload.get("badges", [])]
+		else:
+			answer = {}
+		response = Response()
+		response.status_code = 200
+		response.reason = "OK"
+		response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+		response.encoding = "utf-8"
+		response._content = json.dumps(answer).encode("utf-8")
+		response._content_consumed = True
+		response.url = request.url
+		response.request = request
+		return response
+
+	def close(self):
+		pass
 
+# Unit names by badgeUnitId
+badgeUnits = {
+	1: "mi_km",
+	2: "ft_m",
+	3: "activities",
+	4: "days",
+	5: "steps",
+	6: "mi",
+	7: "seconds"
+}
+
+# Required fields of a Garmin Connect badge, read in one call per badge
+getBadgeFields = operator.itemgetter("badgeId", "badgeName", "badgeEarnedNumber", "badgeEarnedDate", "badgeProgressValue", "badgeTargetValue", "userJoined")
+
+class Badge:
+	# A badge with only the fields that are sent to Garmin Badges. The raw Garmin Connect json of a badge
+	# has a lot more fields, it is dropped as soon as the badge is parsed.
+	__slots__ = ("badgeId", "badgeName", "count", "earnedDate", "badgeProgressValue", "badgeTargetValue", "badgeUnit", "userJoined", "joinDateLocal")
+
+	def __init__(self, badgeId, badgeName, count, earnedDate, badgeProgressValue, badgeTargetValue, badgeUnit="", userJoined=False, joinDateLocal=None):
+		self.badgeId = badgeId
+		self.badgeName = badgeName
+		self.count = count
+		self.earnedDate = earnedDate
+		self.badgeProgressValue = badgeProgressValue
+		self.badgeTargetValue = badgeTargetValue
+		self.badgeUnit = badgeUnit
+		self.userJoined = userJoined
+		self.joinDateLocal = joinDateLocal
+
+	@classmethod
+	def fromConnect(cls, badge):
+		badgeId, badgeName, count, earnedDate, badgeProgressValue, badgeTargetValue, userJoined = getBadgeFields(badge)
+		return cls(badgeId, badgeName, count, earnedDate, badgeProgressValue, badgeTargetValue,
+			badgeUnits.get(badge.get("badgeUnitId"), ""), True if userJoined else False, badge.get("joinDateLocal"))
+
+	@classmethod
+	def fromList(cls, values):
+		return cls(*values)
+
+	def toList(self):
+		# Compact form for the badge cache
+		return [self.badgeId, self.badgeName, self.count, self.earnedDate, self.badgeProgressValue, self.badgeTargetValue, self.badgeUnit, self.userJoined, self.joinDateLocal]
+
+	def toPayload(self, createdBy):
+		# The badge as Garmin Badges expects it
+		return {
+			"badgeId": self.badgeId,
+			"badgeName": self.badgeName,
+			"count": self.count,
+			"earned_date": self.earnedDate,
+			"badgeProgressValue": self.badgeProgressValue,
+			"badgeTargetValue": self.badgeTargetValue,
+			"badgeUnit": self.badgeUnit,
+			"userJoined": self.userJoined,
+			"joinDateLocal": self.joinDateLocal,
+			"createdBy": createdBy
+		}
+
+	def copy(self):
+		return Badge.fromList(self.toList())
+
+	def getFingerprint(self):
+		# The parts of an earned badge that change when its details change
+		return [self.count, self.earnedDate, self.badgeProgressValue]
+
+def main():
 	handleArguments(sys.argv)
 	if(debugMode):
 		printVersion()
 		print("Verbose/debug mode enabled")
 		print("Script started with command: " + ' '.join(sys.argv))
 
-	global userId, updateKey
+	global userId
+
+	if any(argument.split("=")[0] in ("--history-changes", "--history-earned") for argument in sys.argv):
+		printHistory()
+		return
+
+	batchFileName = getArgumentValue("--batch")
+	if "--daemon" in sys.argv or watchMode:
+		runDaemon(batchFileName)
+		return
+	if batchFileName:
+		runBatchSync(batchFileName)
+		return
 
 	configFileName = getConfigFileNameAndMakeSureFolderExists()
 
 	print("Starting Garmin badges sync...")
-	loginToGarminBadgesAndConnect(configFileName)
+	metrics = SyncMetrics()
+	result = {"account": None, "status": "failed", "earned": 0, "details": 0, "failed": 0, "seconds": 0, "error": None, "metrics": metrics}
+	try:
+		import garth
+		if replayArchive:
+			# The replay needs no credentials, the archive answers the requests
+			client = createReplayClient()
+			config = {"gbUsername": None, "gbEmail": None}
+		else:
+			with metrics.phase("login"):
+				loginToGarminBadgesAndConnect(configFileName)
+			with open(configFileName, 'r') as f:
+				config = json.load(f)
+			client = garth.client
+		account = SyncAccount(None, client, getConfigDir(), garthDir, config["gbUsername"], config["gbEmail"])
+		account.metrics = metrics
+		result = syncAccount(account)
+		result["metrics"] = metrics
+	except Exception as e:
+		result["error"] = str(e) or type(e).__name__
+		result["seconds"] = time.time() - metrics.startTime
+		raise
+	finally:
+		writeMetricsReports([result])
+	if result["status"] == "failed":
+		sys.exit(1)
+	userId = account.userId
 
-	print("Fetching user info from Garmin Badges...")
-	fetchUserInfoFromGarminBadgesToGlobalVariables(configFileName)
+	# Open web pages
+	openWebPages(sys.argv)
 
-	doVersionCheck(pythonVersion, version)
+	if(debugMode):
+		print("Script ended.")
 
-	# Fetch earned Json from Garmin.
-	print("Fetching earned badges from Garmin Connect...")
-	garminEarnedJson = garth.connectapi("/badge-service/badge/earned")
-	print(f"Found {len(garminEarnedJson)} earned badges")
+def watchAccount(account):
+	# --watch: only the earned list is fetched. The full sync runs when its fingerprint differs from the
+	# fingerprint of the last complete sync, so a failed upload is tried again at the next poll.
+	startTime = time.time()
+	account.metrics.limiter = account.limiter
+	refreshConnectToken(account.client, account.garthDir)
+	with account.metrics.phase("earned_fetch"):
+		earnedBadges = fetchEarnedBadgesFromGarmin(account)
+	if getEarnedFingerprint(earnedBadges) == loadLastSync(account.configDir).get("fingerprint"):
+		if(debugMode):
+			account.log(f"No changes in {len(earnedBadges)} earned badges")
+		return {"account": account.name, "status": "unchanged", "earned": len(earnedBadges), "details": 0, "failed": 0, "seconds": time.time() - startTime, "error": None}
+	account.log("Earned badges changed, starting sync...")
+	return syncAccount(account, earnedBadges)
 
-	# createGarminBadgesJson
-	strippedGarminEarnedJson = createGarminBadgesJson(garminEarnedJson, updateKey);
+def getEarnedFingerprint(earnedBadges):
+	fingerprints = sorted([badge.badgeId] + badge.getFingerprint() for badge in earnedBadges)
+	return hashlib.sha256(json.dumps(fingerprints).encode("utf-8")).hexdigest()
 
-	# POST stripped Json to Garmin Badges and get badgeIds to fetch from Garmin.
-	print("Posting earned badges to Garmin Badges...")
-	badgesToFetch = postJsonToGarminbadges(strippedGarminEarnedJson, "https://garminbadges.com/api/index.php/user/earned")
+def syncAccount(account, earnedBadges=None):
+	global versionChecked
 
-	# Fetch badges from Garmin
-	print(f"Fetching detailed info for {len(badgesToFetch.json())} badges...")
-	garminBadgeJsonArray = fetchBadgesFromGarmin(badgesToFetch.json());
+	startTime = time.time()
+	metrics = account.metrics
+	metrics.limiter = account.limiter
+	result = {"account": account.name, "status": "synced", "earned": 0, "details": 0, "failed": 0, "seconds": 0, "error": None}
+	refreshConnectToken(account.client, account.garthDir)
 
-	# createGarminBadgesJson.
-	garminBadgeJson = createGarminBadgesJson(garminBadgeJsonArray, updateKey);
+	# Fetch earned Json from Garmin. --watch has fetched it already.
+	if earnedBadges is None:
+		account.log("Fetching earned badges from Garmin Connect...")
+		with metrics.phase("earned_fetch"):
+			earnedBadges = fetchEarnedBadgesFromGarmin(account)
+	account.log(f"Found {len(earnedBadges)} earned badges")
+	result["earned"] = len(earnedBadges)
+	badgesToPost = earnedBadges
 
-	# POST the new badge json to Garmin Badges.
-	print("Posting badge details to Garmin Badges...")
-	gbBadgeResponse = postJsonToGarminbadges(garminBadgeJson, "https://garminbadges.com/api/index.php/user/challenges")
-	print("✓ Successfully synced badges!")
+	# Only upload the badges that changed since the last successful sync
+	if(incrementalMode):
+		lastSync = loadLastSync(account.configDir)
+		badgesToPost = getChangedBadges(lastSync["badges"], earnedBadges)
+		if not badgesToPost:
+			account.log("✓ No changes since the last sync, nothing to upload")
+			account.userId = lastSync["userId"]
+			saveHistory(account, earnedBadges, startTime)
+			if lastSync.get("fingerprint") != getEarnedFingerprint(earnedBadges):
+				# A last sync from before --watch, or badges that were removed
+				saveLastSync(account, earnedBadges)
+			result["status"] = "unchanged"
+			result["seconds"] = time.time() - startTime
+			return result
+		account.log(f"{len(badgesToPost)} badges changed since the last sync")
 
-	# Open web pages
-	openWebPages(sys.argv)
+	account.log("Fetching user info from Garmin Badges...")
+	with metrics.phase("updatekey"):
+		fetchUserInfoFromGarminBadges(account)
 
-	if(debugMode):
-		print("Script ended.")
+	# The version is the same for all accounts, so it's only checked once
+	if not versionChecked:
+		doVersionCheck(account.pythonVersion, version)
+		versionChecked = True
+
+	# POST the stripped badges to Garmin Badges and get badgeIds to fetch from Garmin.
+	account.log("Posting earned badges to Garmin Badges...")
+	with metrics.phase("earned_post"):
+		badgesToFetch = postSerializedBadgesToGarminbadges(badgesToPost, account.updateKey, garminBadgesApiUrl + "/user/earned", False, account)
+		if badgesToFetch.status_code in (401, 403):
+			# The update key from session.json was rejected, get a new one and post again
+			account.log("Update key was rejected, fetching it again...")
+			clearGarminBadgesSession(account)
+			fetchUserInfoFromGarminBadges(account, refresh=True)
+			badgesToFetch = postSerializedBadgesToGarminbadges(badgesToPost, account.updateKey, garminBadgesApiUrl + "/user/earned", False, account)
+
+	# Without the answer there are no badges to fetch, the error body isn't a list of badges
+	if not badgesToFetch.ok:
+		account.log(f"✗ Earned badges were not accepted by Garmin Badges (HTTP {badgesToFetch.status_code})")
+		result["status"] = "failed"
+		result["error"] = f"Posting earned badges to Garmin Badges failed with HTTP {badgesToFetch.status_code}"
+		saveHistory(account, earnedBadges, startTime)
+		result["seconds"] = time.time() - startTime
+		return result
+	badgesToFetch = badgesToFetch.json()
+
+	if(pipelineMode):
+		# Fetch the badges from Garmin and post them to Garmin Badges at the same time
+		account.log(f"Fetching and posting detailed info for {len(badgesToFetch)} badges...")
+		with metrics.phase("details_pipeline"):
+			badgeFetchResults, detailsUploaded = fetchAndPostBadgeDetails(account, badgesToFetch, earnedBadges, garminBadgesApiUrl + "/user/challenges")
+		result["details"] = len([fetchResult for fetchResult in badgeFetchResults if fetchResult["badge"]])
+		result["failed"] = len([fetchResult for fetchResult in badgeFetchResults if fetchResult["error"]])
+	else:
+		# Fetch badges from Garmin
+		account.log(f"Fetching detailed info for {len(badgesToFetch)} badges...")
+		with metrics.phase("detail_fetch"):
+			badgeFetchResults = fetchBadgeDetails(account, badgesToFetch, earnedBadges)
+		garminBadgeJsonArray = [fetchResult["badge"] for fetchResult in badgeFetchResults if fetchResult["badge"]]
+		result["details"] = len(garminBadgeJsonArray)
+		result["failed"] = len([fetchResult for fetchResult in badgeFetchResults if fetchResult["error"]])
+
+		# POST the new badge json to Garmin Badges. It is serialized in chunks of badges, not as one dict.
+		account.log("Posting badge details to Garmin Badges...")
+		with metrics.phase("details_post"):
+			if uploadChunkSize:
+				detailsUploaded = postBadgeDetailsInChunksToGarminbadges(account, garminBadgeJsonArray, garminBadgesApiUrl + "/user/challenges")
+			else:
+				detailsUploaded = postBadgeDetailsToGarminbadges(account, garminBadgeJsonArray, garminBadgesApiUrl + "/user/challenges").ok
+
+	if detailsUploaded and dryRunMode:
+		# Nothing was posted, so neither the log nor the metrics report a sync
+		account.log("Dry run: payloads built, nothing uploaded")
+		result["status"] = "dry-run"
+	elif detailsUploaded:
+		account.log("✓ Successfully synced badges!")
+		saveLastSync(account, earnedBadges)
+	else:
+		# Reported as failed, so the exit code, the metrics and run_sync.sh show it
+		account.log("✗ Badge details were not uploaded to Garmin Badges")
+		result["status"] = "failed"
+		result["error"] = "Upload to Garmin Badges failed"
+	saveHistory(account, earnedBadges, startTime)
+
+	result["seconds"] = time.time() - startTime
+	return result
+
+def runBatchSync(batchFileName):
+	# Sync all accounts in a JSON list of profiles:
+	# [{"name": "anna", "garthDir": "~/.garth-anna", "configDir": "~/.garminbadges/accounts/anna/", "gbUsername": "anna", "gbEmail": "anna@example.com"}]
+	# garthDir and configDir are optional, gbUsername and gbEmail are read from config.json in configDir when left out.
+	results = syncBatch(batchFileName)
+	if any(result["status"] == "failed" for result in results):
+		sys.exit(1)
+
+def syncBatch(batchFileName, sync=syncAccount):
+	with open(os.path.expanduser(batchFileName), 'r') as f:
+		profiles = json.load(f)
+
+	print(f"Starting Garmin badges sync for {len(profiles)} accounts...")
+	with concurrent.futures.ThreadPoolExecutor(max_workers=batchWorkers) as executor:
+		results = list(executor.map(lambda profile: syncBatchProfile(profile, sync), profiles))
+
+	printBatchResults(results)
+	writeMetricsReports(results)
+	return results
+
+def createBatchAccount(profile, metrics):
+	name = profile["name"]
+	accountGarthDir = profile.get("garthDir", "~/.garth-" + name)
+	accountConfigDir = os.path.join(os.path.expanduser(profile.get("configDir", getConfigDir() + "accounts/" + name)), "")
+	Path(accountConfigDir).mkdir(parents=True, exist_ok=True)
+
+	gbUsername = profile.get("gbUsername")
+	gbEmail = profile.get("gbEmail")
+	if replayArchive:
+		account = SyncAccount(name, createReplayClient(), accountConfigDir, None, gbUsername, gbEmail)
+		account.metrics = metrics
+		return account
+	if not gbUsername or not gbEmail:
+		with open(accountConfigDir + "config.json", 'r') as f:
+			config = json.load(f)
+		gbUsername = gbUsername or config["gbUsername"]
+		gbEmail = gbEmail or config["gbEmail"]
+
+	import garth
+	client = garth.Client()
+	with metrics.phase("login"):
+		try:
+			client.load(accountGarthDir)
+		except OSError:
+			raise Exception(f"No Garmin Connect session in {accountGarthDir}. Log in with: --garth-dir={accountGarthDir} --config-dir={accountConfigDir}")
+	client.configure(timeout=requestTimeout)
+	# All accounts share one connection pool to Garmin Connect
+	client.sess.mount("https://", getConnectAdapter())
+	account = SyncAccount(name, client, accountConfigDir, accountGarthDir, gbUsername, gbEmail)
+	account.metrics = metrics
+	return account
+
+def syncBatchProfile(profile, sync=syncAccount):
+	# A failing account is reported in the result table and doesn't stop the other accounts
+	metrics = SyncMetrics()
+	try:
+		result = sync(createBatchAccount(profile, metrics))
+	except Exception as e:
+		print(f"[{profile.get('name')}] ✗ Sync failed: {e}")
+		result = {"account": profile.get("name"), "status": "failed", "earned": 0, "details": 0, "failed": 0, "seconds": time.time() - metrics.startTime, "error": str(e) or type(e).__name__}
+	result["metrics"] = metrics
+	return result
+
+def writeMetricsReports(results):
+	metricsJsonFileName = getArgumentValue("--metrics-json")
+	if metricsJsonFileName:
+		writeFileAtomically(metricsJsonFileName, json.dumps(createMetricsReport(results), indent=2))
+	metricsPromFileName = getArgumentValue("--metrics-prom")
+	if metricsPromFileName:
+		writeFileAtomically(metricsPromFileName, createPrometheusMetrics(results))
+
+def writeFileAtomically(fileName, content):
+	# The Prometheus textfile collector may read the file at any time, so it's replaced in one step
+	fileName = os.path.expanduser(fileName)
+	with open(fileName + ".tmp", 'w') as f:
+		f.write(content)
+	os.replace(fileName + ".tmp", fileName)
+
+def createMetricsReport(results):
+	accounts = []
+	for result in results:
+		metrics = result["metrics"]
+		accounts.append({
+			"account": result["account"] or "default",
+			"status": result["status"],
+			"error": result["error"],
+			"startTime": metrics.startTime,
+			"seconds": result["seconds"],
+			"badges": {"earned": result["earned"], "details": result["details"], "failed": result["failed"]},
+			"phases": metrics.phases,
+			"requests": metrics.requests,
+			"connectLimiter": metrics.limiter.getStats() if metrics.limiter else None
+		})
+	return {"version": version, "latencyBuckets": SyncMetrics.latencyBuckets, "accounts": accounts}
+
+def createPrometheusMetrics(results):
+	# The text format wants all lines of a metric together after its HELP and TYPE,
+	# so the samples are collected per metric over all accounts first
+	families = {
+		"garminbadges_sync_success": ("gauge", "Whether the last sync of the account succeeded."),
+		"garminbadges_sync_timestamp_seconds": ("gauge", "Start time of the last sync."),
+		"garminbadges_badges": ("gauge", "Number of badges in the last sync."),
+		"garminbadges_phase_duration_seconds": ("gauge", "Duration of each phase of the last sync."),
+		"garminbadges_request_errors": ("gauge", "Number of failed Garmin Connect requests in the last sync."),
+		"garminbadges_connect_concurrency_limit": ("gauge", "Concurrency limit for Garmin Connect requests at the end of the last sync."),
+		"garminbadges_connect_throttled": ("gauge", "Garmin Connect requests that were throttled (429, 5xx or connection errors) in the last sync."),
+		"garminbadges_request_duration_seconds": ("histogram", "Latency of the Garmin Connect requests in the last sync.")
+	}
+	samples = {name: [] for name in families}
+	for result in results:
+		metrics = result["metrics"]
+		account = 'account="' + (result["account"] or "default").replace('"', '') + '"'
+		samples["garminbadges_sync_success"].append(f"garminbadges_sync_success{{{account}}} {0 if result['status'] == 'failed' else 1}")
+		samples["garminbadges_sync_timestamp_seconds"].append(f"garminbadges_sync_timestamp_seconds{{{account}}} {metrics.startTime:.0f}")
+		for kind in ("earned", "details", "failed"):
+			samples["garminbadges_badges"].append(f'garminbadges_badges{{{account},kind="{kind}"}} {result[kind]}')
+		if metrics.limiter:
+			limiterStats = metrics.limiter.getStats()
+			samples["garminbadges_connect_concurrency_limit"].append(f"garminbadges_connect_concurrency_limit{{{account}}} {limiterStats['limit']}")
+			samples["garminbadges_connect_throttled"].append(f"garminbadges_connect_throttled{{{account}}} {limiterStats['throttled']}")
+		for name, phase in metrics.phases.items():
+			samples["garminbadges_phase_duration_seconds"].append(f'garminbadges_phase_duration_seconds{{{account},phase="{name}"}} {phase["seconds"]:.6f}')
+		for endpoint, request in metrics.requests.items():
+			labels = f'{account},endpoint="{endpoint}"'
+			samples["garminbadges_request_errors"].append(f"garminbadges_request_errors{{{labels}}} {request['errors']}")
+			histogram = samples["garminbadges_request_duration_seconds"]
+			for bucket, count in zip(SyncMetrics.latencyBuckets, request["buckets"]):
+				histogram.append(f'garminbadges_request_duration_seconds_bucket{{{labels},le="{bucket}"}} {count}')
+			histogram.append(f'garminbadges_request_duration_seconds_bucket{{{labels},le="+Inf"}} {request["count"]}')
+			histogram.append(f"garminbadges_request_duration_seconds_sum{{{labels}}} {request['seconds']:.6f}")
+			histogram.append(f"garminbadges_request_duration_seconds_count{{{labels}}} {request['count']}")
+
+	lines = []
+	for name, (metricType, help) in families.items():
+		lines.append(f"# HELP {name} {help}")
+		lines.append(f"# TYPE {name} {metricType}")
+		lines.extend(samples[name])
+	return "\n".join(lines) + "\n"
+
+def printBatchResults(results):
+	print("")
+	print(f"{'Account':<20} {'Status':<10} {'Earned':>7} {'Details':>8} {'Failed':>7} {'Seconds':>8}")
+	for result in results:
+		print(f"{str(result['account']):<20} {result['status']:<10} {result['earned']:>7} {result['details']:>8} {result['failed']:>7} {result['seconds']:>8.1f}")
+		if result["error"]:
+			print(f"    {result['error']}")
+
+def runDaemon(batchFileName):
+	# --daemon: stay running and sync every --interval minutes. The imports, the Garmin Connect session and the
+	# connection pools stay warm between syncs, and the local HTTP endpoint shows how the last sync went.
+	# --watch: poll the earned badges instead and only sync when they changed.
+	sync = watchAccount if watchMode else syncAccount
+	if batchFileName:
+		runSync = lambda: syncBatch(batchFileName, sync)
+	else:
+		configFileName = getConfigFileNameAndMakeSureFolderExists()
+		loginToGarminBadgesAndConnect(configFileName)
+		runSync = lambda: [syncDefaultAccount(configFileName, sync)]
 
-	#print("--- %s seconds ---" % (time.time() - start_time))
+	if watchMode:
+		backoff = IdleBackoff(pollInterval, maxPollInterval)
+		daemon = SyncDaemon(lambda: backoff.update(runSync()), backoff.getInterval, lambda: backoff.getInterval() / 10)
+	else:
+		daemon = SyncDaemon(runSync, lambda: daemonInterval, lambda: daemonJitter)
+	if daemonHttpPort:
+		daemon.startHttpServer(daemonHttpPort)
+		print(f"Status on http://127.0.0.1:{daemonHttpPort}/status, POST /sync to start a sync")
+	if watchMode:
+		print(f"Checking for new badges every {pollInterval / 60:.0f} to {maxPollInterval / 60:.0f} minutes, Ctrl+C to stop")
+	else:
+		print(f"Syncing every {daemonInterval / 60:.0f} minutes, Ctrl+C to stop")
+	try:
+		daemon.run()
+	except KeyboardInterrupt:
+		print("Stopped")
+
+def syncDefaultAccount(configFileName, sync=syncAccount):
+	# A sync of the account in config.json with the garth session that is already logged in
+	import garth
+	metrics = SyncMetrics()
+	try:
+		with open(configFileName, 'r') as f:
+			config = json.load(f)
+		account = SyncAccount(None, garth.client, getConfigDir(), garthDir, config["gbUsername"], config["gbEmail"])
+		account.metrics = metrics
+		result = sync(account)
+	except Exception as e:
+		print(f"✗ Sync failed: {e}")
+		result = {"account": None, "status": "failed", "earned": 0, "details": 0, "failed": 0, "seconds": time.time() - metrics.startTime, "error": str(e) or type(e).__name__}
+	result["metrics"] = metrics
+	writeMetricsReports([result])
+	return result
+
+def getConnectAdapter():
+	global connectAdapter
+	with sessionLock:
+		if not connectAdapter:
+			connectAdapter = createConnectAdapter(batchWorkers, maxWorkersLimit * batchWorkers)
+		return connectAdapter
+
+def createConnectAdapter(poolConnections, poolMaxsize):
+	# garth's own adapter retries 429 and 5xx inside urllib3 and then raises a RetryError without a response,
+	# so the limiter would never see them. This one only retries connection errors and timeouts (urllib3 would
+	# also retry on a Retry-After header), throttled responses reach callConnectApi, which halves the limit,
+	# honours Retry-After and retries with --connect-retries. Each layer retries its own errors, not both.
+	from requests.adapters import HTTPAdapter, Retry
+	return HTTPAdapter(
+		max_retries=Retry(total=connectRetries, status_forcelist=(), respect_retry_after_header=False, backoff_factor=0.5, raise_on_status=False),
+		pool_connections=poolConnections,
+		pool_maxsize=poolMaxsize
+	)
+
+def getGarminBadgesSession():
+	# One keep-alive session for all garminbadges.com requests.
+	# 429 and 5xx responses are retried with exponential backoff and jitter, a Retry-After header is honoured.
+	global garminBadgesSession
+	import requests
+	from requests.adapters import HTTPAdapter, Retry
+	with sessionLock:
+		if not garminBadgesSession:
+			retry = Retry(
+				total=uploadRetries,
+				backoff_factor=1,
+				backoff_jitter=1,
+				status_forcelist=(429, 500, 502, 503, 504),
+				allowed_methods=frozenset(["GET", "POST"]),
+				raise_on_status=False
+			)
+			# Every account of --batch can post --upload-workers chunks at the same time
+			adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=batchWorkers * uploadWorkers)
+			garminBadgesSession = requests.Session()
+			garminBadgesSession.mount("https://", adapter)
+			garminBadgesSession.mount("http://", adapter)
+			if dryRunMode:
+				# Nothing is posted, the payloads are only built
+				dryRunAdapter = DryRunAdapter(dryRunDir)
+				garminBadgesSession.mount("https://", dryRunAdapter)
+				garminBadgesSession.mount("http://", dryRunAdapter)
+			else:
+				useHttpArchive(garminBadgesSession)
+		return garminBadgesSession
+
+def useHttpArchive(session):
+	# With --record the responses of the session are written to the archive, with --replay they come from it
+	for prefix in ("https://", "http://"):
+		adapter = session.get_adapter(prefix)
+		if replayArchive and not isinstance(adapter, ReplayAdapter):
+			session.mount(prefix, ReplayAdapter(replayArchive))
+			# Without network the proxy settings aren't needed, reading them is most of the time of a replayed request
+			session.trust_env = False
+		elif recordArchive and not isinstance(adapter, RecordingAdapter):
+			session.mount(prefix, RecordingAdapter(recordArchive, adapter))
+
+def getHttpArchiveKey(method, url):
+	# garminbadges.com requests are stored relative to --api-url and Garmin Connect requests by their path,
+	# so an archive can be replayed against other hosts, e.g. one recorded with the benchmark mock
+	if url.startswith(garminBadgesApiUrl):
+		return method + " " + url[len(garminBadgesApiUrl):]
+	from urllib.parse import urlsplit
+	parts = urlsplit(url)
+	return method + " " + parts.path + ("?" + parts.query if parts.query else "")
+
+def createReplayClient():
+	# A garth client with tokens that never expire, its requests are answered by the replay archive
+	import garth
+	from garth.auth_tokens import OAuth1Token, OAuth2Token
+	client = garth.Client()
+	client.configure(timeout=requestTimeout)
+	farFuture = int(time.time()) + 365 * 24 * 3600
+	client.oauth1_token = OAuth1Token(oauth_token="replay", oauth_token_secret="replay")
+	client.oauth2_token = OAuth2Token(scope="", jti="", token_type="Bearer", access_token="replay", refresh_token="replay",
+		expires_in=365 * 24 * 3600, expires_at=farFuture, refresh_token_expires_in=365 * 24 * 3600, refresh_token_expires_at=farFuture)
+	return client
+
+def getConfigDir():
+	return os.path.join(os.path.expanduser(configDir), "")
 
 def getConfigFileNameAndMakeSureFolderExists():
-	configDir = os.path.expanduser('~') + "/.garminbadges/"
+	configDir = getConfigDir()
 	configFileName = configDir + "config.json"
 	Path(configDir).mkdir(parents=True, exist_ok=True)
 	return configFileName
 
+def getLastSyncFileName(accountConfigDir):
+	return accountConfigDir + "last-sync.json"
+
+def loadLastSync(accountConfigDir):
+	try:
+		with open(getLastSyncFileName(accountConfigDir), 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {"userId": 0, "badges": []}
+
+def saveLastSync(account, earnedBadges):
+	# Nothing was posted in a dry run, so the next run has to post these badges
+	if dryRunMode:
+		return
+	lastSyncFileName = getLastSyncFileName(account.configDir)
+	with open(lastSyncFileName + ".tmp", 'w') as f:
+		f.write('{"userId": ' + json.dumps(account.userId) + ', "fingerprint": "' + getEarnedFingerprint(earnedBadges) + '", "badges": ')
+		f.writelines(iterBadgesJsonChunks(earnedBadges))
+		f.write("}")
+	os.replace(lastSyncFileName + ".tmp", lastSyncFileName)
+
+def getHistoryFileName():
+	return os.path.expanduser(historyFileName) if historyFileName else getConfigDir() + "history.sqlite"
+
+def openHistory():
+	# All accounts share one database. Every sync adds a run and a snapshot of each earned badge in that run.
+	import sqlite3
+	connection = sqlite3.connect(getHistoryFileName(), timeout=30)
+	# WAL lets the accounts of --batch write while the query options read
+	connection.execute("PRAGMA journal_mode=WAL")
+	connection.execute("PRAGMA synchronous=NORMAL")
+	connection.executescript("""
+		CREATE TABLE IF NOT EXISTS runs (runId INTEGER PRIMARY KEY, account TEXT NOT NULL, runAt REAL NOT NULL);
+		CREATE INDEX IF NOT EXISTS runsByAccount ON runs (account, runAt);
+		CREATE TABLE IF NOT EXISTS badges (badgeId INTEGER PRIMARY KEY, badgeName TEXT, badgeUnit TEXT);
+		CREATE TABLE IF NOT EXISTS snapshots (
+			runId INTEGER NOT NULL, account TEXT NOT NULL, badgeId INTEGER NOT NULL, runAt REAL NOT NULL,
+			badgeProgressValue REAL, badgeTargetValue REAL, count INTEGER, earnedDate TEXT,
+			PRIMARY KEY (runId, badgeId)
+		) WITHOUT ROWID;
+		CREATE INDEX IF NOT EXISTS snapshotsByBadge ON snapshots (account, badgeId, runAt);
+		CREATE INDEX IF NOT EXISTS snapshotsByEarnedDate ON snapshots (account, earnedDate);
+	""")
+	return connection
+
+def saveHistory(account, earnedBadges, runAt):
+	# A broken history doesn't fail the sync
+	if not historyMode:
+		return
+	accountName = account.name or "default"
+	try:
+		with account.metrics.phase("history"):
+			connection = openHistory()
+			try:
+				# One transaction for the whole run
+				with connection:
+					runId = connection.execute("INSERT INTO runs (account, runAt) VALUES (?, ?)", (accountName, runAt)).lastrowid
+					connection.executemany("INSERT OR REPLACE INTO badges (badgeId, badgeName, badgeUnit) VALUES (?, ?, ?)",
+						[(badge.badgeId, badge.badgeName, badge.badgeUnit) for badge in earnedBadges])
+					connection.executemany("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+						[(runId, accountName, badge.badgeId, runAt, badge.badgeProgressValue, badge.badgeTargetValue, badge.count, badge.earnedDate) for badge in earnedBadges])
+			finally:
+				connection.close()
+	except Exception as e:
+		account.log(f"Could not save the badge history: {e}")
+
+def getHistoryDays(name, default):
+	value = getArgumentValue(name)
+	return float(value) if value else default
+
+def printHistory():
+	# --history-changes and --history-earned only read the history, nothing is synced
+	if not os.path.exists(getHistoryFileName()):
+		print(f"No badge history in {getHistoryFileName()}")
+		return
+	connection = openHistory()
+	try:
+		accountName = getArgumentValue("--history-account")
+		if accountName:
+			accounts = [accountName]
+		else:
+			accounts = [row[0] for row in connection.execute("SELECT DISTINCT account FROM runs ORDER BY account")]
+		for accountName in accounts:
+			print(f"=== {accountName} ===")
+			if any(argument.split("=")[0] == "--history-changes" for argument in sys.argv):
+				printHistoryChanges(connection, accountName, getHistoryDays("--history-changes", 7))
+			if any(argument.split("=")[0] == "--history-earned" for argument in sys.argv):
+				printHistoryEarned(connection, accountName, getHistoryDays("--history-earned", 30))
+	finally:
+		connection.close()
+
+def printHistoryChanges(connection, accountName, days):
+	# Compares the last run with the last run before the period, or the first run in it
+	since = time.time() - days * 24 * 3600
+	lastRun = connection.execute("SELECT runId FROM runs WHERE account = ? ORDER BY runAt DESC LIMIT 1", (accountName,)).fetchone()
+	firstRun = connection.execute("SELECT runId FROM runs WHERE account = ? AND runAt < ? ORDER BY runAt DESC LIMIT 1", (accountName, since)).fetchone() \
+		or connection.execute("SELECT runId FROM runs WHERE account = ? AND runAt >= ? ORDER BY runAt LIMIT 1", (accountName, since)).fetchone()
+	if not lastRun:
+		print("No runs")
+		return
+	rows = connection.execute("""
+		SELECT last.badgeId, badges.badgeName, badges.badgeUnit, first.badgeProgressValue, last.badgeProgressValue, last.badgeTargetValue, first.count, last.count
+		FROM snapshots AS last
+		LEFT JOIN snapshots AS first ON first.runId = ? AND first.badgeId = last.badgeId
+		LEFT JOIN badges ON badges.badgeId = last.badgeId
+		WHERE last.runId = ? AND (first.badgeId IS NULL OR first.badgeProgressValue IS NOT last.badgeProgressValue OR first.count IS NOT last.count)
+		ORDER BY badges.badgeName
+	""", (firstRun[0], lastRun[0])).fetchall()
+	print(f"Progress in the last {days:g} days: {len(rows)} badges changed")
+	for badgeId, badgeName, badgeUnit, fromValue, toValue, targetValue, fromCount, toCount in rows:
+		change = f"{fromValue if fromValue is not None else '-'} -> {toValue}"
+		if targetValue:
+			change += f" of {targetValue:g}"
+		if badgeUnit:
+			change += f" {badgeUnit}"
+		if (fromCount or 0) != (toCount or 0):
+			change += f", earned {toCount}x"
+		print(f"   {badgeName or badgeId}: {change}")
+
+def printHistoryEarned(connection, accountName, days):
+	since = time.strftime("%Y-%m-%d", time.localtime(time.time() - days * 24 * 3600))
+	rows = connection.execute("""
+		SELECT snapshots.badgeId, badges.badgeName, MAX(snapshots.earnedDate), MAX(snapshots.count)
+		FROM snapshots LEFT JOIN badges ON badges.badgeId = snapshots.badgeId
+		WHERE snapshots.account = ? AND snapshots.earnedDate >= ?
+		GROUP BY snapshots.badgeId ORDER BY 3 DESC
+	""", (accountName, since)).fetchall()
+	print(f"Earned in the last {days:g} days: {len(rows)} badges")
+	for badgeId, badgeName, earnedDate, count in rows:
+		print(f"   {earnedDate[:10]} {badgeName or badgeId}" + (f" ({count}x)" if count and count > 1 else ""))
+
+def getChangedBadges(lastBadges, badges):
+	# New badges and badges with a changed progress value or earned count
+	lastBadgesById = {badge["badgeId"]: badge for badge in lastBadges}
+	changedBadges = []
+	for badge in badges:
+		lastBadge = lastBadgesById.get(badge.badgeId)
+		if not lastBadge:
+			if(debugMode):
+				print(f"New badge: {badge.badgeName}")
+			changedBadges.append(badge)
+		elif lastBadge["badgeProgressValue"] != badge.badgeProgressValue or lastBadge["count"] != badge.count:
+			if(debugMode):
+				print(f"Changed badge: {badge.badgeName}")
+			changedBadges.append(badge)
+	return changedBadges
+
+def getArgumentValue(name, default=None):
+	# Options with a value are passed as --name=value
+	for argument in sys.argv:
+		if argument.startswith(name + "="):
+			return argument[len(name) + 1:]
+	return default
+
 def handleArguments(arguments):
-	global debugMode
+	global debugMode, maxWorkers, maxWorkersLimit, connectRetries, requestTimeout, asyncMode, incrementalMode
+	global garthDir, configDir, batchWorkers
+	global connectTimeout, readTimeout, uploadRetries, gzipUploads
+	global garminBadgesApiUrl, uploadChunkSize, uploadWorkers, pipelineMode
+	global daemonInterval, daemonJitter, daemonHttpPort, watchMode, pollInterval, maxPollInterval
+	global badgeCacheMode, badgeCacheTtl, badgeCacheMaxEntries, sessionTtl, historyMode, historyFileName
+	global recordArchive, replayArchive, dryRunMode, dryRunDir
 
 	if "--version" in sys.argv:
 		printVersion()
@@ -116,17 +1268,88 @@ def handleArguments(arguments):
 		sys.exit(0)
 	if "--V" in sys.argv:
 		debugMode = True
+	if "--async" in sys.argv:
+		asyncMode = True
+	if "--gzip" in sys.argv:
+		gzipUploads = True
+	if "--incremental" in sys.argv:
+		incrementalMode = True
+	if "--pipeline" in sys.argv:
+		pipelineMode = True
+	if "--no-cache" in sys.argv:
+		badgeCacheMode = "off"
+	elif "--refresh-cache" in sys.argv:
+		badgeCacheMode = "refresh"
+	badgeCacheTtl = float(getArgumentValue("--cache-ttl", badgeCacheTtl / 3600)) * 3600
+	badgeCacheMaxEntries = int(getArgumentValue("--cache-size", badgeCacheMaxEntries))
+	sessionTtl = float(getArgumentValue("--session-ttl", sessionTtl / 3600)) * 3600
+	if "--no-history" in sys.argv:
+		historyMode = False
+	historyFileName = getArgumentValue("--history-file", historyFileName)
+	daemonInterval = max(60, float(getArgumentValue("--interval", daemonInterval / 60)) * 60)
+	daemonJitter = float(getArgumentValue("--jitter", daemonInterval / 10 / 60)) * 60
+	daemonHttpPort = int(getArgumentValue("--http-port", daemonHttpPort))
+	watchMode = "--watch" in sys.argv
+	pollInterval = max(30, float(getArgumentValue("--poll-interval", pollInterval / 60)) * 60)
+	maxPollInterval = max(pollInterval, float(getArgumentValue("--max-poll-interval", maxPollInterval / 60)) * 60)
+	maxWorkers = max(1, int(getArgumentValue("--workers", maxWorkers)))
+	maxWorkersLimit = max(maxWorkers, int(getArgumentValue("--max-workers", maxWorkersLimit)))
+	connectRetries = max(0, int(getArgumentValue("--connect-retries", connectRetries)))
+	batchWorkers = max(1, int(getArgumentValue("--batch-workers", batchWorkers)))
+	garthDir = getArgumentValue("--garth-dir", garthDir)
+	connectTimeout = float(getArgumentValue("--connect-timeout", connectTimeout))
+	readTimeout = float(getArgumentValue("--read-timeout", readTimeout))
+	uploadRetries = int(getArgumentValue("--retries", uploadRetries))
+	garminBadgesApiUrl = getArgumentValue("--api-url", garminBadgesApiUrl).rstrip("/")
+	uploadChunkSize = max(0, int(getArgumentValue("--upload-chunk-size", uploadChunkSize)))
+	uploadWorkers = max(1, int(getArgumentValue("--upload-workers", uploadWorkers)))
+	configDir = getArgumentValue("--config-dir", configDir)
+	requestTimeout = float(getArgumentValue("--timeout", requestTimeout))
+	if getArgumentValue("--record") or getArgumentValue("--replay"):
+		if "--daemon" in sys.argv or watchMode:
+			print("--record and --replay can't be used with --daemon or --watch")
+			sys.exit(1)
+		# aiohttp doesn't go through the requests sessions the archive is attached to
+		asyncMode = False
+	if getArgumentValue("--record"):
+		# Everything is downloaded, so the archive has all responses a replay needs
+		recordArchive = HttpArchive(getArgumentValue("--record"), "record")
+		badgeCacheMode = "refresh"
+		sessionTtl = 0
+		incrementalMode = False
+	if getArgumentValue("--replay"):
+		replayArchive = HttpArchive(getArgumentValue("--replay"), "replay")
+		# The caches, the session and the history of a replay are kept apart from the real ones
+		if not getArgumentValue("--config-dir"):
+			import tempfile, shutil, atexit
+			configDir = tempfile.mkdtemp(prefix="garminbadges-replay-")
+			atexit.register(shutil.rmtree, configDir, True)
+	if "--dry-run" in sys.argv or getArgumentValue("--dry-run"):
+		dryRunMode = True
+		dryRunDir = getArgumentValue("--dry-run")
+		historyMode = False
+	# garth, requests and asyncio are imported where they are used, so --version, --help and the history
+	# queries start fast.
+
 
+def configureGarth():
+	# Size the connection pool to the number of workers so connections are reused
+	import garth
+	garth.configure(timeout=requestTimeout)
+	garth.client.sess.mount("https://", createConnectAdapter(maxWorkersLimit, maxWorkersLimit))
 
 def loginToGarminBadgesAndConnect(configFileName):
+	import garth
+	configureGarth()
 	try:
 		# Check if config file exists
 		f = open(configFileName, "r")
                 
 		if "--clear" in sys.argv:
 			raise Exception
-		garth.resume("~/.garth")
-		garth.client.username
+		garth.resume(garthDir)
+		# The session is checked without a request to Garmin Connect, only an expiring token is refreshed
+		refreshConnectToken(garth.client, garthDir)
 	except Exception as e:
 		if(debugMode):
 			print("Session is expired or an error occured. You'll need to log in again");
@@ -142,23 +1365,80 @@ def loginToGarminBadgesAndConnect(configFileName):
 		gcPassword = getpass("Enter Garmin Connect password: ")
 		# If there's MFA, you'll be prompted during the login
 		garth.login(gcEmail, gcPassword)
-		garth.save("~/.garth")
+		garth.save(garthDir)
 
-def fetchUserInfoFromGarminBadgesToGlobalVariables(configFileName):
-	global pythonVersion, updateKey, userId
+def refreshConnectToken(client, clientGarthDir):
+	# Refresh the OAuth2 token before it expires, instead of garth refreshing it in the middle of the fetch in
+	# whichever thread gets there first. The new token is saved so the next runs don't have to refresh it again.
+	token = client.oauth2_token
+	if token and token.expires_at - time.time() > tokenRefreshMargin:
+		return
+	client.refresh_oauth2()
+	# A dry run keeps the token in memory, the saved one still works for the next run to refresh
+	if clientGarthDir and not dryRunMode:
+		client.dump(clientGarthDir)
 
-	with open(configFileName, 'r') as f:
-		config = json.load(f)
+def fetchUserInfoFromGarminBadges(account, refresh=False):
+	# The user id and update key hardly ever change, so they are kept in session.json for --session-ttl hours
+	if not refresh and loadGarminBadgesSession(account):
+		if(debugMode):
+			account.log("Using the update key from session.json")
+		return
 
 	# Get update key and user id from garminbadges.com
 	updateKeyJson = {
-		"username": config["gbUsername"],
-		"email": config["gbEmail"]
+		"username": account.gbUsername,
+		"email": account.gbEmail
 	}
-	response = postJsonToGarminbadges(updateKeyJson, "https://garminbadges.com/api/index.php/user/updatekey")
-	userId = response.json()["id"]
-	updateKey = response.json()["update_key"]
-	pythonVersion = response.json()["python_script_version"]
+	response = postJsonToGarminbadges(updateKeyJson, garminBadgesApiUrl + "/user/updatekey")
+	account.userId = response.json()["id"]
+	account.updateKey = response.json()["update_key"]
+	account.pythonVersion = response.json()["python_script_version"]
+	saveGarminBadgesSession(account)
+
+def getSessionFileName(accountConfigDir):
+	return accountConfigDir + "session.json"
+
+def loadGarminBadgesSession(account):
+	if not sessionTtl:
+		return False
+	try:
+		with open(getSessionFileName(account.configDir), 'r') as f:
+			session = json.load(f)
+	except (OSError, ValueError):
+		return False
+	# A session of other Garmin Badges credentials (after --clear) or from another API isn't used
+	if [session.get("gbUsername"), session.get("gbEmail"), session.get("apiUrl")] != [account.gbUsername, account.gbEmail, garminBadgesApiUrl]:
+		return False
+	if time.time() - session.get("fetchedAt", 0) > sessionTtl:
+		return False
+	account.userId = session["userId"]
+	account.updateKey = session["updateKey"]
+	account.pythonVersion = session["pythonVersion"]
+	return True
+
+def saveGarminBadgesSession(account):
+	if not sessionTtl or dryRunMode:
+		return
+	session = {
+		"gbUsername": account.gbUsername,
+		"gbEmail": account.gbEmail,
+		"apiUrl": garminBadgesApiUrl,
+		"userId": account.userId,
+		"updateKey": account.updateKey,
+		"pythonVersion": account.pythonVersion,
+		"fetchedAt": time.time()
+	}
+	sessionFileName = getSessionFileName(account.configDir)
+	with open(sessionFileName + ".tmp", 'w') as f:
+		json.dump(session, f)
+	os.replace(sessionFileName + ".tmp", sessionFileName)
+
+def clearGarminBadgesSession(account):
+	try:
+		os.remove(getSessionFileName(account.configDir))
+	except OSError:
+		pass
 
 def doVersionCheck(latestVersion, currentVersion):
 	if (latestVersion == currentVersion):
@@ -176,96 +1456,520 @@ def doVersionCheck(latestVersion, currentVersion):
 				print("Script is outdated and will not run. Get the latest version (v.{}) at https://garminbadges.com/upload/garminbadges-updater.py".format(latestVersion))
 				sys.exit()
 
-def fetchOneBadgeFromGarmin(badgeNo, badgeUuid, badgeJson):
+def fetchBadgeDetails(account, badgesToFetch, earnedBadges, onResult=None):
+	import asyncio
+	# Serve unchanged badges from the local cache and only download the rest.
+	# onResult is called with every result as soon as it is there, the downloads are then always done with threads.
+	badgeCache = loadBadgeCache(account.configDir)
+	earnedFingerprints = {str(badge.badgeId): badge.getFingerprint() for badge in earnedBadges}
+	cachedResults, badgesToDownload = takeBadgesFromCache(badgeCache, badgesToFetch, earnedFingerprints)
+	if cachedResults:
+		account.log(f"Using {len(cachedResults)} cached badges, downloading {len(badgesToDownload)}")
+	if onResult:
+		for cachedResult in cachedResults:
+			onResult(cachedResult)
+
+	if not badgesToDownload:
+		downloadedResults = []
+	elif(asyncMode and not onResult):
+		downloadedResults = asyncio.run(fetchBadgesFromGarminAsync(account, badgesToDownload))
+	else:
+		downloadedResults = fetchBadgesFromGarmin(account, badgesToDownload, onResult)
+
+	storeBadgesInCache(badgeCache, badgesToDownload, downloadedResults)
+	saveBadgeCache(account.configDir, badgeCache)
+	return sorted(cachedResults + downloadedResults, key=lambda result: result["badgeNo"])
+
+def getBadgeCacheFileName(accountConfigDir):
+	return accountConfigDir + "badge-cache.json"
+
+def getBadgeCacheKey(badgeNo, badgeUuid):
+	return str(badgeNo) + ":" + (badgeUuid or "")
+
+def loadBadgeCache(accountConfigDir):
+	if badgeCacheMode == "off":
+		return {}
+	try:
+		with open(getBadgeCacheFileName(accountConfigDir), 'r') as f:
+			badgeCache = json.load(f)
+	except (OSError, ValueError):
+		return {}
+	# Badges are cached as Badge lists, entries from older versions with the full Garmin Connect json are dropped
+	return {key: dict(entry, badge=Badge.fromList(entry["badge"])) for key, entry in badgeCache.items() if isinstance(entry.get("badge"), list)}
+
+def saveBadgeCache(accountConfigDir, badgeCache):
+	if badgeCacheMode == "off" or dryRunMode:
+		return
+
+	# Evict the least recently used badges when the cache is full
+	if len(badgeCache) > badgeCacheMaxEntries:
+		keys = sorted(badgeCache, key=lambda key: badgeCache[key]["lastUsed"], reverse=True)
+		badgeCache = {key: badgeCache[key] for key in keys[:badgeCacheMaxEntries]}
+
+	# Write to a temporary file first so an interrupted run can't leave a broken cache
+	cacheFileName = getBadgeCacheFileName(accountConfigDir)
+	with open(cacheFileName + ".tmp", 'w') as f:
+		json.dump({key: dict(entry, badge=entry["badge"].toList()) for key, entry in badgeCache.items()}, f)
+	os.replace(cacheFileName + ".tmp", cacheFileName)
+
+def takeBadgesFromCache(badgeCache, badgesToFetch, earnedFingerprints):
+	now = time.time()
+	cachedResults = []
+	badgesToDownload = []
+	for badge in badgesToFetch:
+		cacheEntry = None
+		if badgeCacheMode == "use":
+			cacheEntry = badgeCache.get(getBadgeCacheKey(badge["badgeNo"], badge["badgeUuid"]))
+		fingerprint = earnedFingerprints.get(str(badge["badgeNo"]))
+
+		# Without a fingerprint a changed badge can't be recognized, so it is revalidated with its ETag every run
+		if cacheEntry and fingerprint is not None and now - cacheEntry["fetchedAt"] < badgeCacheTtl and cacheEntry["fingerprint"] == fingerprint:
+			cacheEntry["lastUsed"] = now
+			cachedResults.append({"badgeNo": badge["badgeNo"], "badge": cacheEntry["badge"], "etag": cacheEntry["etag"], "error": None})
+		else:
+			badgesToDownload.append(dict(badge, cacheEntry=cacheEntry, fingerprint=fingerprint))
+	return cachedResults, badgesToDownload
+
+def storeBadgesInCache(badgeCache, badgesToDownload, results):
+	if badgeCacheMode == "off":
+		return
+	now = time.time()
+	downloadedBadges = {badge["badgeNo"]: badge for badge in badgesToDownload}
+	for result in results:
+		if result["badge"] and not result["error"]:
+			badge = downloadedBadges[result["badgeNo"]]
+			badgeCache[getBadgeCacheKey(badge["badgeNo"], badge["badgeUuid"])] = {
+				"badge": result["badge"],
+				"etag": result["etag"],
+				"fingerprint": badge["fingerprint"],
+				"fetchedAt": now,
+				"lastUsed": now
+			}
+
+def fetchEarnedBadgesFromGarmin(account):
+	# The earned list is parsed badge by badge while it downloads, so the full Garmin Connect json with
+	# all its fields is never in memory. Only the Badge records are kept.
+	path = "/badge-service/badge/earned"
+	response = callConnectApi(account, path, lambda: account.client.request("GET", "connectapi", path, api=True, stream=True))
+	with response:
+		if response.status_code == 204:
+			return []
+		textChunks = iterDecodedContent(response.iter_content(chunk_size=65536))
+		return [Badge.fromConnect(badge) for badge in iterJsonArray(textChunks) if badge]
+
+def iterDecodedContent(contentChunks):
+	# Connect sends UTF-8 json without a charset, so requests can't decode the chunks itself
+	decoder = codecs.getincrementaldecoder("utf-8")()
+	for chunk in contentChunks:
+		yield decoder.decode(chunk)
+	yield decoder.decode(b"", final=True)
+
+jsonSeparators = re.compile(r"[\s,]*")
+jsonItemEnd = re.compile(r"\s*[,\]]")
+
+def iterJsonArray(textChunks):
+	# Yields the items of a JSON array one by one from the chunks of its text
+	decoder = json.JSONDecoder()
+	buffer = ""
+	arrayStarted = False
+	for chunk in textChunks:
+		buffer += chunk
+		position = 0
+		while True:
+			position = jsonSeparators.match(buffer, position).end()
+			if position == len(buffer):
+				break
+			if not arrayStarted:
+				if buffer[position] != "[":
+					raise ValueError("Expected a JSON array")
+				arrayStarted = True
+				position += 1
+				continue
+			if buffer[position] == "]":
+				return
+			try:
+				item, end = decoder.raw_decode(buffer, position)
+			except json.JSONDecodeError:
+				# The item continues in the next chunk
+				break
+			if not jsonItemEnd.match(buffer, end):
+				# A number could continue in the next chunk too
+				break
+			yield item
+			position = end
+		buffer = buffer[position:]
+	raise ValueError("Incomplete JSON array")
+
+def connectApi(account, path, **kwargs):
+	return callConnectApi(account, path, lambda: account.client.connectapi(path, **kwargs))
+
+def connectApiResponse(account, path, headers=None):
+	# Like connectApi, but returns the response so status and headers can be read
+	return callConnectApi(account, path, lambda: account.client.request("GET", "connectapi", path, api=True, headers=headers or {}))
+
+def callConnectApi(account, path, call):
+	# Every Garmin Connect request waits for the adaptive limiter of the account. Throttled requests are retried.
+	for attempt in range(connectRetries + 1):
+		account.limiter.acquire()
+		requestStart = time.perf_counter()
+		status = None
+		retryAfter = None
+		try:
+			with account.metrics.request(path):
+				response = call()
+			status = 200
+			return response
+		except Exception as e:
+			status, retryAfter = getThrottleInfo(e)
+			# Connection errors and timeouts were already retried by the adapter, they only slow down the limiter
+			if status == 0 or not isThrottledStatus(status) or attempt == connectRetries:
+				raise
+		finally:
+			account.limiter.release(time.perf_counter() - requestStart, status, retryAfter)
+		# A Retry-After header pauses all requests in the limiter, otherwise only this request backs off
+		if not retryAfter:
+			time.sleep(getRetryBackoff(attempt))
+
+def getThrottleInfo(exception):
+	# garth wraps the requests HTTPError in GarthHTTPError
+	response = getattr(getattr(exception, "error", None), "response", None)
+	if response is None:
+		response = getattr(exception, "response", None)
+	if response is None:
+		import requests
+		if isinstance(exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.RetryError)):
+			return 0, None
+		return None, None
+	return response.status_code, parseRetryAfter(response.headers.get("Retry-After"))
+
+def isThrottledStatus(status):
+	# 0 is a connection error or timeout
+	return status is not None and (status == 0 or status == 429 or status >= 500)
+
+def parseRetryAfter(retryAfter):
 	try:
-		garminBadgeResponse = garth.connectapi("/badge-service/badge/detail/v2/" + str(badgeNo))
+		return float(retryAfter)
+	except (TypeError, ValueError):
+		return None
+
+def getRetryBackoff(attempt):
+	return 2 ** attempt * 0.5
+
+def fetchBadgeDetailFromGarmin(account, badgeNo, cacheEntry=None):
+	# Revalidate a cached badge with its ETag, Connect answers 304 when it hasn't changed
+	headers = {}
+	if cacheEntry and cacheEntry.get("etag"):
+		headers["If-None-Match"] = cacheEntry["etag"]
+	response = connectApiResponse(account, "/badge-service/badge/detail/v2/" + str(badgeNo), headers)
+	if response.status_code == 304:
+		return cacheEntry["badge"].copy(), cacheEntry["etag"]
+	if response.status_code == 204:
+		return None, None
+	return Badge.fromConnect(response.json()), response.headers.get("ETag")
+
+def fetchOneBadgeFromGarmin(account, badgeNo, badgeUuid, cacheEntry, challengeExecutor):
+	# Returns a result for the badge instead of raising, so one failing badge doesn't stop the others.
+	# A badge whose challenge lookup fails is still returned with its details, but with the error set.
+	result = {"badgeNo": badgeNo, "badge": None, "etag": None, "error": None}
+	try:
+		# The challenge lookup only needs the uuid, so it runs on the challenge executor while the details are fetched
+		challengeFuture = None
 		if badgeUuid:
-			garminBadgeResponseUuid = garth.connectapi("/badgechallenge-service/badgeChallenge/" + badgeUuid)
-			garminBadgeResponse["joinDateLocal"] = garminBadgeResponseUuid["joinDateLocal"]
-		badgeJson.append(garminBadgeResponse)
+			challengePath = "/badgechallenge-service/badgeChallenge/" + badgeUuid
+			challengeFuture = account.coalescer.submit(challengeExecutor, challengePath, lambda: connectApi(account, challengePath))
+		detailPath = "/badge-service/badge/detail/v2/" + str(badgeNo)
+		result["badge"], result["etag"] = account.coalescer.call(detailPath, lambda: fetchBadgeDetailFromGarmin(account, badgeNo, cacheEntry))
+		if not result["badge"]:
+			result["error"] = "Empty response"
+		elif challengeFuture:
+			# Another badge can share the detail result, so the copy gets the join date
+			result["badge"] = result["badge"].copy()
+			result["badge"].joinDateLocal = challengeFuture.result()["joinDateLocal"]
 	except Exception as e:
-		if not garminBadgeResponse:
-			badgeJson.append("")
+		result["error"] = str(e) or type(e).__name__
+	return result
+
+def fetchBadgesFromGarmin(account, badgesToFetch, onResult=None):
+	results = []
+	# The adaptive limiter decides how many of the threads send requests at the same time.
+	# Badges are submitted as results come in, so a slow onResult also slows down the fetch.
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkersLimit)
+	challengeExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkersLimit)
+	badgeIterator = iter(badgesToFetch)
+	pendingFutures = set()
+	try:
+		while True:
+			for badge in itertools.islice(badgeIterator, maxWorkersLimit * 2 - len(pendingFutures)):
+				pendingFutures.add(executor.submit(fetchOneBadgeFromGarmin, account, badge["badgeNo"], badge["badgeUuid"], badge.get("cacheEntry"), challengeExecutor))
+			if not pendingFutures:
+				break
+			doneFutures, pendingFutures = concurrent.futures.wait(pendingFutures, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in doneFutures:
+				results.append(future.result())
+				if onResult:
+					onResult(results[-1])
+	finally:
+		# Drop queued requests on Ctrl+C or errors, running ones finish within the request timeout
+		executor.shutdown(wait=True, cancel_futures=True)
+		challengeExecutor.shutdown(wait=True, cancel_futures=True)
+
+	results.sort(key=lambda result: result["badgeNo"])
+	reportBadgeFetchResults(account, results)
+	return results
+
+async def fetchConnectJsonAsync(session, account, path, cacheEntry=None, parse=None):
+	# parse turns the json into the returned object, a 304 returns the cached badge
+	import asyncio
+	import aiohttp
+	headers = {}
+	if cacheEntry and cacheEntry.get("etag"):
+		headers["If-None-Match"] = cacheEntry["etag"]
+	connectApiUrl = account.connectApiUrl or "https://connectapi." + account.client.domain
+
+	# Same limiter and retries as callConnectApi
+	for attempt in range(connectRetries + 1):
+		await account.limiter.acquireAsync()
+		requestStart = time.perf_counter()
+		status = None
+		retryAfter = None
+		try:
+			with account.metrics.request(path):
+				async with session.get(connectApiUrl + path, headers=headers) as response:
+					status = response.status
+					retryAfter = parseRetryAfter(response.headers.get("Retry-After"))
+					response.raise_for_status()
+					if response.status == 304:
+						return cacheEntry["badge"].copy(), cacheEntry["etag"]
+					if response.status == 204:
+						return None, None
+					responseJson = await response.json(content_type=None)
+					return parse(responseJson) if parse else responseJson, response.headers.get("ETag")
+		except aiohttp.ClientResponseError:
+			if not isThrottledStatus(status) or attempt == connectRetries:
+				raise
+		except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+			status = 0
+			raise
+		finally:
+			account.limiter.release(time.perf_counter() - requestStart, status, retryAfter)
+		if not retryAfter:
+			await asyncio.sleep(getRetryBackoff(attempt))
+
+async def fetchOneBadgeFromGarminAsync(session, account, badgeNo, badgeUuid, cacheEntry=None):
+	# Same result as fetchOneBadgeFromGarmin, but the detail and challenge requests run at the same time
+	import asyncio
+	result = {"badgeNo": badgeNo, "badge": None, "etag": None, "error": None}
+	detailPath = "/badge-service/badge/detail/v2/" + str(badgeNo)
+	calls = [account.coalescer.callAsync(detailPath, lambda: fetchConnectJsonAsync(session, account, detailPath, cacheEntry, Badge.fromConnect))]
+	if badgeUuid:
+		challengePath = "/badgechallenge-service/badgeChallenge/" + badgeUuid
+		calls.append(account.coalescer.callAsync(challengePath, lambda: fetchConnectJsonAsync(session, account, challengePath), True))
+	responses = await asyncio.gather(*calls, return_exceptions=True)
+
+	for response in responses:
+		if isinstance(response, Exception):
+			result["error"] = str(response) or type(response).__name__
+	if not isinstance(responses[0], Exception) and responses[0][0]:
+		result["badge"], result["etag"] = responses[0]
+		if badgeUuid and not isinstance(responses[1], Exception):
+			result["badge"] = result["badge"].copy()
+			# A challenge without a join date (or a 204) keeps the badge, like the thread path
+			try:
+				result["badge"].joinDateLocal = responses[1][0]["joinDateLocal"]
+			except Exception as e:
+				result["error"] = str(e) or type(e).__name__
+	elif not result["error"]:
+		result["error"] = "Empty response"
+	return result
+
+async def fetchBadgesFromGarminAsync(account, badgesToFetch):
+	import asyncio
+	try:
+		import aiohttp
+	except ImportError:
+		print("The --async option needs aiohttp. Install it with: python -m pip install aiohttp")
+		sys.exit(1)
+
+	# Reuse the OAuth2 token and headers of the garth session
+	refreshConnectToken(account.client, account.garthDir)
+	headers = dict(account.client.sess.headers)
+	headers["Authorization"] = str(account.client.oauth2_token)
+
+	account.limiter.releasedEvent = asyncio.Event()
+	timeout = aiohttp.ClientTimeout(total=requestTimeout)
+	connector = aiohttp.TCPConnector(limit=maxWorkersLimit)
+	async with aiohttp.ClientSession(headers=headers, timeout=timeout, connector=connector) as session:
+		results = await asyncio.gather(*[fetchOneBadgeFromGarminAsync(session, account, badge["badgeNo"], badge["badgeUuid"], badge.get("cacheEntry")) for badge in badgesToFetch])
+
+	results = sorted(results, key=lambda result: result["badgeNo"])
+	reportBadgeFetchResults(account, results)
+	return results
+
+def reportBadgeFetchResults(account, results):
+	failedResults = [result for result in results if result["error"]]
+	if(debugMode):
+		for result in results:
+			if not result["error"]:
+				account.log(f"✓ Badge {result['badgeNo']}")
+	for result in failedResults:
+		if result["badge"]:
+			account.log(f"⚠️  Badge {result['badgeNo']} fetched without challenge info: {result['error']}")
 		else:
-			badgeJson.append(garminBadgeResponse)
-	return True
+			account.log(f"✗ Badge {result['badgeNo']} failed: {result['error']}")
+	account.log(f"Fetched {len(results) - len(failedResults)} of {len(results)} badges")
 
-def fetchBadgesFromGarmin(badgesToFetch):
-	NO_OF_THREADS_BEFORE_START = threading.active_count()
-	badgeJson = []
-	threads = []
-	threadIndex = 0
-	runningThreads = 0
-	
-	maxNumberOfRunningThreads = 10
 
-	# Create all threads
-	for badge in badgesToFetch:
-		process = Thread(target=fetchOneBadgeFromGarmin, args=[badge["badgeNo"], badge["badgeUuid"], badgeJson])
-		threads.append(process)
+def fetchAndPostBadgeDetails(account, badgesToFetch, earnedBadges, url):
+	# --pipeline: fetched badges go through a bounded queue to an upload thread that posts them in batches,
+	# while the next badges are fetched. When the uploads fall behind, the full queue holds up the fetch.
+	batchSize = uploadChunkSize or pipelineBatchSize
+	resultQueue = queue.Queue(maxsize=batchSize * 2)
+	uploadState = {"batches": 0, "failed": 0}
+	uploadThread = threading.Thread(target=postBadgeBatchesFromQueue, args=(account, resultQueue, batchSize, url, uploadState))
+	uploadThread.start()
+	try:
+		results = fetchBadgeDetails(account, badgesToFetch, earnedBadges, resultQueue.put)
+	finally:
+		resultQueue.put(None)
+		uploadThread.join()
 
-	# Limit the number of started threads to not exceed the thread pool
-	while len(badgeJson) < len(threads):
-		if(threadIndex < len(threads) and threading.active_count() - NO_OF_THREADS_BEFORE_START < maxNumberOfRunningThreads):
-			threads[threadIndex].start()
-			threadIndex += 1
-	return badgeJson
+	if uploadState["failed"]:
+		account.log(f"✗ {uploadState['failed']} of {uploadState['batches']} uploads failed")
+	return results, uploadState["failed"] == 0
 
+def postBadgeBatchesFromQueue(account, resultQueue, batchSize, url, uploadState):
+	# Keeps reading the queue until the end marker even when uploads fail, the fetch would block on a full queue otherwise
+	batch = []
+	while True:
+		result = resultQueue.get()
+		if result is not None and result["badge"]:
+			batch.append(result["badge"])
+		# Without any badges an empty list is posted, like without --pipeline
+		if len(batch) == batchSize or (result is None and (batch or not uploadState["batches"])):
+			uploadState["batches"] += 1
+			try:
+				if not postBadgeDetailsToGarminbadges(account, batch, url).ok:
+					uploadState["failed"] += 1
+			except Exception as e:
+				account.log(f"Upload of {len(batch)} badges failed: {e}")
+				uploadState["failed"] += 1
+			batch = []
+		if result is None:
+			return
 
 def postJsonToGarminbadges(json, url):
 	headers = {'Content-type': 'application/json'}
-	return requests.post(url, headers=headers, json=json)
-
-def createGarminBadgesJson(json, updateKey):
-	newJson = []
-	joinDateLocal = None;
-
-	unitArray = {
-		1: "mi_km",
-		2: "ft_m",
-		3: "activities",
-		4: "days",
-		5: "steps",
-		6: "mi",
-		7: "seconds"
-	}
+	return getGarminBadgesSession().post(url, headers=headers, json=json, timeout=(connectTimeout, readTimeout))
 
-	for badge in json:
-		if not badge:
-			continue
-		badgeUnit = ""
-		try:
-			badgeUnit = unitArray[badge["badgeUnitId"]]
-		except KeyError as e:
-			badgeUnit = ""
-
-		if "joinDateLocal" in badge:
-			joinDateLocal = badge["joinDateLocal"]
-			
-		newBadge = {
-			"badgeId": badge["badgeId"],
-			"badgeName": badge["badgeName"],
-			"count": badge["badgeEarnedNumber"],
-			"earned_date": badge["badgeEarnedDate"],
-			"badgeProgressValue": badge["badgeProgressValue"],
-			"badgeTargetValue": badge["badgeTargetValue"],
-			"badgeUnit": badgeUnit,
-			"userJoined": True if badge["userJoined"] else False,
-			"joinDateLocal": joinDateLocal,
-			"createdBy": "Python script v." + version
-		}
-		newJson.append(newBadge);
+def postBadgeDetailsToGarminbadges(account, garminBadgeJsonArray, url):
+	# The badge details are the biggest upload, so they can be sent gzip compressed with --gzip.
+	# Servers that don't accept a compressed body get it again uncompressed.
+	response = postSerializedBadgesToGarminbadges(garminBadgeJsonArray, account.updateKey, url, gzipUploads, account)
+	if gzipUploads and response.status_code in (400, 411, 415):
+		account.log(f"Compressed upload was rejected ({response.status_code}), sending it uncompressed")
+		response = postSerializedBadgesToGarminbadges(garminBadgeJsonArray, account.updateKey, url, False, account)
+	return response
 
-	newJson = {
-		"update_key": updateKey,
-		"badges": newJson
-	}
+def postSerializedBadgesToGarminbadges(garminBadgeJsonArray, updateKey, url, compress, account):
+	headers = {'Content-type': 'application/json'}
+	if compress:
+		headers["Content-Encoding"] = "gzip"
+	uploadSize = {"raw": 0, "sent": 0}
+	body = serializeGarminBadgesJson(garminBadgeJsonArray, updateKey, compress, uploadSize)
+	if compress or debugMode:
+		account.log(f"Upload size: {uploadSize['raw']} bytes, {uploadSize['sent']} bytes sent")
+	return getGarminBadgesSession().post(url, headers=headers, data=body, timeout=(connectTimeout, readTimeout))
+
+def postBadgeDetailsInChunksToGarminbadges(account, garminBadgeJsonArray, url):
+	# Post the badge details in chunks of --upload-chunk-size badges. Acknowledged chunks are written to a journal,
+	# so when the upload fails a new run with the same badges only posts the chunks that are missing.
+	newBadges = createGarminBadges(garminBadgeJsonArray)
+	chunks = [newBadges[index:index + uploadChunkSize] for index in range(0, len(newBadges), uploadChunkSize)] or [[]]
+	uploadId = hashlib.sha256(json.dumps(newBadges, sort_keys=True).encode("utf-8")).hexdigest()
+
+	journal = loadUploadJournal(account.configDir)
+	if journal["uploadId"] != uploadId or journal["chunkSize"] != uploadChunkSize:
+		journal = {"uploadId": uploadId, "chunkSize": uploadChunkSize, "acknowledged": []}
+	elif journal["acknowledged"]:
+		account.log(f"Resuming upload, {len(journal['acknowledged'])} of {len(chunks)} chunks were already posted")
+	chunksToPost = [index for index in range(len(chunks)) if index not in journal["acknowledged"]]
+
+	journalLock = threading.Lock()
+	def postChunk(index):
+		response = postJsonToGarminbadges({"update_key": account.updateKey, "badges": chunks[index]}, url)
+		if response.ok:
+			with journalLock:
+				journal["acknowledged"].append(index)
+				saveUploadJournal(account.configDir, journal)
+		elif(debugMode):
+			account.log(f"Chunk {index + 1} of {len(chunks)} failed with status {response.status_code}")
+		return response
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=uploadWorkers) as executor:
+		responses = list(executor.map(postChunk, chunksToPost))
+
+	failedResponses = [response for response in responses if not response.ok]
+	if failedResponses:
+		account.log(f"✗ {len(failedResponses)} of {len(chunks)} chunks failed, run again to resume the upload")
+		return False
+	if not dryRunMode and os.path.exists(getUploadJournalFileName(account.configDir)):
+		os.remove(getUploadJournalFileName(account.configDir))
+	return True
+
+def getUploadJournalFileName(accountConfigDir):
+	return accountConfigDir + "upload-journal.json"
+
+def loadUploadJournal(accountConfigDir):
+	try:
+		with open(getUploadJournalFileName(accountConfigDir), 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {"uploadId": None, "chunkSize": 0, "acknowledged": []}
+
+def saveUploadJournal(accountConfigDir, journal):
+	if dryRunMode:
+		return
+	journalFileName = getUploadJournalFileName(accountConfigDir)
+	with open(journalFileName + ".tmp", 'w') as f:
+		json.dump(journal, f)
+	os.replace(journalFileName + ".tmp", journalFileName)
+
+def serializeGarminBadgesJson(garminBadgeJsonArray, updateKey, compress, uploadSize):
+	# The JSON is written in chunks of badges straight into the compressor, so there is no dict of the whole
+	# payload and with --gzip only the compressed body is held in full. Without --gzip the body is the whole
+	# encoded payload. It stays bytes rather than a generator, so the session's retries can send it again.
+	compressor = zlib.compressobj(wbits=31) if compress else None
+	parts = []
+	for chunk in iterGarminBadgesJsonChunks(garminBadgeJsonArray, updateKey):
+		chunk = chunk.encode("utf-8")
+		uploadSize["raw"] += len(chunk)
+		parts.append(compressor.compress(chunk) if compressor else chunk)
+	if compressor:
+		parts.append(compressor.flush())
+	body = b"".join(parts)
+	uploadSize["sent"] = len(body)
+	return body
+
+def iterGarminBadgesJsonChunks(garminBadges, updateKey):
+	yield '{"update_key": ' + json.dumps(updateKey) + ', "badges": '
+	yield from iterBadgesJsonChunks(garminBadges)
+	yield "}"
+
+def iterBadgesJsonChunks(garminBadges, badgesPerChunk=100):
+	# Every chunk of badges is serialized in one call, json.dumps per badge is a lot slower
+	yield "["
+	for index in range(0, len(garminBadges), badgesPerChunk):
+		yield ("" if index == 0 else ", ") + json.dumps(createGarminBadges(garminBadges[index:index + badgesPerChunk]))[1:-1]
+	yield "]"
 
-	return newJson
+def createGarminBadges(badges):
+	createdBy = "Python script v." + version
+	return [badge.toPayload(createdBy) for badge in badges]
 
 
 def openWebPages(arguments):
 	global userId
+	import webbrowser
 	if "--open-badges" in sys.argv:
 		webbrowser.open_new_tab("https://garminbadges.com/index.php?userId=" + str(userId))
 	if "--open-challenges" in sys.argv:
@@ -277,11 +1981,51 @@ def printVersion():
 def printHelp():
 	print("Usage: garminbadges-updater.py [options]\n")
 	print("Options and arguments:")
+	print("   --api-url=URL     : garminbadges.com API to upload to, for testing against a local server.")
+	print("   --async           : Fetch badge details with asyncio (needs aiohttp).")
+	print("   --batch=FILE      : Sync all accounts in a JSON list of account profiles.")
+	print("   --batch-workers=N : Number of accounts synced at the same time (default 4).")
+	print("   --cache-size=N    : Maximum number of badges in the local cache (default 5000).")
+	print("   --cache-ttl=HOURS : Hours before a cached badge is downloaded again (default 168).")
 	print("   --clear           : Enter user credentials again.")
+	print("   --config-dir=DIR  : Folder for Garmin Badges credentials and caches (default ~/.garminbadges).")
+	print("   --connect-retries=N : Retries for Garmin Connect requests that are throttled (default 3).")
+	print("   --connect-timeout=SECONDS : Connect timeout for garminbadges.com requests (default 10).")
+	print("   --daemon          : Keep running and sync every --interval minutes, with a status endpoint on --http-port.")
+	print("   --dry-run[=DIR]   : Build the garminbadges.com payloads without posting them, and save them in DIR.")
+	print("   --garth-dir=DIR   : Folder for the Garmin Connect session (default ~/.garth).")
+	print("   --gzip            : Gzip compress the badge details upload.")
 	print("   --help            : This information about options and arguments.")
+	print("   --history-account=NAME : Only show the history of this account (default all, \"default\" without --batch).")
+	print("   --history-changes[=DAYS] : Show the badge progress of the last DAYS days from the history and exit (default 7).")
+	print("   --history-earned[=DAYS] : Show the badges earned in the last DAYS days from the history and exit (default 30).")
+	print("   --history-file=FILE : SQLite file with the badge history (default ~/.garminbadges/history.sqlite).")
+	print("   --http-port=PORT  : Local port of the --daemon status endpoint (default 8787, 0 to turn it off).")
+	print("   --incremental     : Only upload badges that changed since the last sync.")
+	print("   --interval=MINUTES : Minutes between the syncs of --daemon (default 60).")
+	print("   --jitter=MINUTES  : Random extra delay of each --daemon sync (default a tenth of --interval).")
+	print("   --max-poll-interval=MINUTES : Longest time between the checks of --watch when nothing changes (default 60).")
+	print("   --max-workers=N   : Highest number of parallel Garmin Connect requests the limiter may reach (default 30).")
+	print("   --metrics-json=FILE : Write phase durations and request latencies of the run as JSON.")
+	print("   --metrics-prom=FILE : Write the run metrics for the Prometheus textfile collector.")
+	print("   --no-cache        : Don't read or write the local badge cache.")
+	print("   --no-history      : Don't add the earned badges of this sync to the badge history.")
 	print("   --open-badges     : Open badge page after update.")
 	print("   --open-challenges : Open challenge page after update.")
+	print("   --pipeline        : Post badge details in batches of --upload-chunk-size (default 50) while the next badges are fetched.")
+	print("   --poll-interval=MINUTES : Time between the checks of --watch, doubled after every check without changes (default 5).")
+	print("   --read-timeout=SECONDS : Read timeout for garminbadges.com requests (default 60).")
+	print("   --record=FILE     : Save all Garmin Connect and garminbadges.com responses of a full sync in FILE (JSONL.gz). It contains your garminbadges.com update key, keep it private.")
+	print("   --refresh-cache   : Download all badges again and refresh the local cache.")
+	print("   --replay=FILE     : Sync with the responses in a --record archive instead of the network.")
+	print("   --retries=N       : Retries for garminbadges.com requests that fail with 429 or 5xx (default 3).")
+	print("   --session-ttl=HOURS : Hours the Garmin Badges update key is reused without asking garminbadges.com (default 24, 0 to always ask).")
+	print("   --timeout=SECONDS : Timeout for each Garmin Connect request (default 30).")
+	print("   --upload-chunk-size=N : Upload badge details in chunks of N badges and resume failed uploads.")
+	print("   --upload-workers=N : Number of chunks uploaded at the same time (default 2).")
 	print("   --version         : Print version of the script.")
+	print("   --watch           : Keep running and only sync when the earned badges on Garmin Connect changed.")
+	print("   --workers=N       : Number of parallel Garmin Connect requests to start with (default 10).")
 	print("   --V               : Verbose/debug mode.")
 
 
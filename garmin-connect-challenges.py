@@ -3,30 +3,28 @@
 import os
 import time
 import logging
-import json
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException, WebDriverException
 from dotenv import load_dotenv
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-import urllib3
 import ssl
 import platform
 import sys
 import subprocess
 import tempfile
 import shutil
-import requests
-from selenium.webdriver import ActionChains
-import undetected_chromedriver as uc
-from xvfbwrapper import Xvfb
 import random
+import json
+import hashlib
+import argparse
+import concurrent.futures
+from datetime import date, datetime
+
+# garth, selenium, undetected_chromedriver, xvfbwrapper, requests and urllib3 are imported in the functions that
+# use them, so the script doesn't pay for them when it stops early, e.g. without credentials.
 
-# Disable SSL verification warnings
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+AVAILABLE_CHALLENGES_PATH = "/badgechallenge-service/badgeChallenge/available"
+# The join request is the one the Garmin Connect web app sends when Join is clicked. It isn't a documented
+# API, so it's kept here in one place in case Garmin changes it.
+JOIN_CHALLENGE_METHOD = "PUT"
+JOIN_CHALLENGE_PATH = "/badgechallenge-service/badgeChallenge/{uuid}/optIn"
 
 # Create an SSL context that doesn't verify certificates
 ssl._create_default_https_context = ssl._create_unverified_context
@@ -68,88 +66,173 @@ def get_system_info():
     
     return system, arch
 
+CHROME_BINARIES = ['chromium-browser', 'chromium', 'google-chrome', 'google-chrome-stable']
+# Chrome for Testing lists the newest ChromeDriver of every Chrome major version. Both URLs can point to a
+# local file server, e.g. for tests or a mirror.
+CHROMEDRIVER_VERSIONS_URL = os.getenv("CHROMEDRIVER_VERSIONS_URL", "https://googlechromelabs.github.io/chrome-for-testing/latest-versions-per-milestone-with-downloads.json")
+CHROMEDRIVER_CACHE_DIR = os.path.expanduser(os.getenv("CHROMEDRIVER_CACHE_DIR", "~/.cache/garmin-badges-sync/chromedriver"))
+CHROMEDRIVER_VERSIONS_KEPT = 2
+
 def get_chrome_version():
     """Get the installed Chrome/Chromium version"""
-    try:
-        # Try chromium-browser first (common on Linux)
-        result = subprocess.run(['chromium-browser', '--version'], 
-                              capture_output=True, 
-                              text=True)
-        if result.returncode == 0:
-            version = result.stdout.strip().split()[-1].split('.')[0]
-            return int(version)
-    except:
-        pass
-    
-    try:
-        # Try chrome as fallback
-        result = subprocess.run(['google-chrome', '--version'], 
-                              capture_output=True, 
-                              text=True)
-        if result.returncode == 0:
-            version = result.stdout.strip().split()[-1].split('.')[0]
-            return int(version)
-    except:
-        pass
+    # The version is cached for each browser binary and only asked again when the binary changed
+    probe_file = os.path.join(CHROMEDRIVER_CACHE_DIR, "chrome-version.json")
+    for binary in CHROME_BINARIES:
+        binary_path = shutil.which(binary)
+        if not binary_path:
+            continue
+        try:
+            binary_mtime = os.stat(binary_path).st_mtime
+            probe = read_json_file(probe_file, {})
+            if probe.get("binary") == binary_path and probe.get("mtime") == binary_mtime:
+                return probe["version"]
+            result = subprocess.run([binary_path, '--version'], 
+                                  capture_output=True, 
+                                  text=True)
+            if result.returncode == 0:
+                version = int(result.stdout.strip().split()[-1].split('.')[0])
+                write_json_file(probe_file, {"binary": binary_path, "mtime": binary_mtime, "version": version})
+                return version
+        except Exception:
+            pass
     
     # Default to latest known version if detection fails
     return 131
 
-def download_chromedriver(system, arch):
-    """Download ChromeDriver based on system and architecture"""
+def read_json_file(file_name, default):
+    try:
+        with open(file_name, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def write_json_file(file_name, content):
+    """Replace the file in one step, so a crash never leaves half a file"""
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name + ".tmp", 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(file_name + ".tmp", file_name)
+
+def get_file_sha256(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def get_chromedriver_platform(system, arch):
+    """Chrome for Testing platform name of the system and architecture"""
+    if system == 'mac':
+        return 'mac-arm64' if arch == 'arm64' else 'mac-x64'
+    if system == 'windows':
+        return 'win64' if arch in ['x64', 'arm64'] else 'win32'
+    if system == 'linux' and arch == 'x64':
+        return 'linux64'
+    raise Exception(f"No ChromeDriver downloads for {system} {arch}")
+
+def get_chromedriver(system, arch, chrome_version):
+    """Path of a ChromeDriver for the Chrome major version, from the cache or downloaded once"""
+    platform_path = get_chromedriver_platform(system, arch)
+    key = f"{chrome_version}-{platform_path}"
+    driver_dir = os.path.join(CHROMEDRIVER_CACHE_DIR, key)
+    driver_name = 'chromedriver.exe' if system == 'windows' else 'chromedriver'
+    driver_path = os.path.join(driver_dir, driver_name)
+    manifest_file = os.path.join(CHROMEDRIVER_CACHE_DIR, "manifest.json")
+
+    manifest = read_json_file(manifest_file, {})
+    entry = manifest.get(key)
+    if entry and os.path.exists(driver_path) and get_file_sha256(driver_path) == entry["sha256"]:
+        logger.info(f"Using cached ChromeDriver {entry['version']}")
+    else:
+        if entry:
+            logger.info(f"Cached ChromeDriver for Chrome {chrome_version} is damaged, downloading it again")
+        version = download_chromedriver(chrome_version, platform_path, driver_dir, driver_name)
+        manifest = read_json_file(manifest_file, {})
+        entry = {"version": version, "sha256": get_file_sha256(driver_path)}
+    entry["usedAt"] = time.time()
+    manifest[key] = entry
+    prune_chromedrivers(manifest)
+    write_json_file(manifest_file, manifest)
+
+    # undetected_chromedriver patches the binary it is given, so it gets a copy and the checked original stays as it is
+    patched_path = os.path.join(driver_dir, "uc-" + driver_name)
+    if not os.path.exists(patched_path):
+        shutil.copy2(driver_path, patched_path + ".tmp")
+        os.replace(patched_path + ".tmp", patched_path)
+    return patched_path
+
+def prune_chromedrivers(manifest):
+    """Remove all but the most recently used ChromeDrivers from the cache"""
+    keys = sorted(manifest, key=lambda key: manifest[key].get("usedAt", 0), reverse=True)
+    for key in keys[CHROMEDRIVER_VERSIONS_KEPT:]:
+        logger.info(f"Removing cached ChromeDriver {manifest[key]['version']}")
+        shutil.rmtree(os.path.join(CHROMEDRIVER_CACHE_DIR, key), ignore_errors=True)
+        del manifest[key]
+
+def download_chromedriver(chrome_version, platform_path, driver_dir, driver_name):
+    """Download ChromeDriver for the Chrome major version and platform into driver_dir, returns its version"""
+    import requests
+    import urllib3
+
+    # Disable SSL verification warnings
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
     try:
-        chrome_version = get_chrome_version()
-        if not chrome_version:
-            raise Exception("Could not determine Chrome version")
-            
         logger.info(f"Chrome version: {chrome_version}")
         
-        # Determine the correct download URL based on system and architecture
-        if system == 'mac':
-            if arch == 'arm64':
-                platform_path = 'mac-arm64'
-            else:
-                platform_path = 'mac-x64'
-        elif system == 'windows':
-            platform_path = 'win64' if arch in ['x64', 'arm64'] else 'win32'
-        else:  # linux
-            platform_path = 'linux64'
-            
-        download_url = f"https://edgedl.me.gvt1.com/edgedl/chrome/chrome-for-testing/{chrome_version}.0.6778.87/{platform_path}/chromedriver-{platform_path}.zip"
-        
-        # Create a temporary directory
-        temp_dir = tempfile.mkdtemp()
-        zip_path = os.path.join(temp_dir, "chromedriver.zip")
-        
-        # Download the file
-        logger.info(f"Downloading ChromeDriver from {download_url}")
-        response = requests.get(download_url, verify=False)
+        # Look up the newest build of the major version instead of a fixed build number
+        response = requests.get(CHROMEDRIVER_VERSIONS_URL, verify=False, timeout=30)
         response.raise_for_status()
-        
-        with open(zip_path, 'wb') as f:
-            f.write(response.content)
-        
-        # Extract the zip file
-        logger.info("Extracting ChromeDriver...")
-        shutil.unpack_archive(zip_path, temp_dir)
-        
-        # Find the chromedriver binary
-        chromedriver_path = None
-        for root, dirs, files in os.walk(temp_dir):
-            for file in files:
-                if file == 'chromedriver' or file == 'chromedriver.exe':
-                    chromedriver_path = os.path.join(root, file)
+        milestone = response.json()["milestones"].get(str(chrome_version))
+        if not milestone:
+            raise Exception(f"No ChromeDriver for Chrome {chrome_version}")
+        downloads = [download for download in milestone["downloads"].get("chromedriver", []) if download["platform"] == platform_path]
+        if not downloads:
+            raise Exception(f"No ChromeDriver for Chrome {chrome_version} on {platform_path}")
+        download = downloads[0]
+        
+        # Everything is unpacked next to the cache, so the driver is moved into place in one step
+        os.makedirs(CHROMEDRIVER_CACHE_DIR, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=CHROMEDRIVER_CACHE_DIR, prefix=".download-") as temp_dir:
+            zip_path = os.path.join(temp_dir, "chromedriver.zip")
+            
+            # Download the file
+            logger.info(f"Downloading ChromeDriver {milestone['version']} from {download['url']}")
+            with requests.get(download["url"], verify=False, timeout=60, stream=True) as response:
+                response.raise_for_status()
+                with open(zip_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+            
+            # Only a mirror that publishes checksums can be checked before the zip is unpacked
+            if download.get("sha256") and get_file_sha256(zip_path) != download["sha256"]:
+                raise Exception("Checksum of the downloaded ChromeDriver doesn't match")
+            
+            # Extract the zip file
+            logger.info("Extracting ChromeDriver...")
+            extract_dir = os.path.join(temp_dir, "extracted")
+            shutil.unpack_archive(zip_path, extract_dir)
+            
+            # Find the chromedriver binary
+            chromedriver_path = None
+            for root, dirs, files in os.walk(extract_dir):
+                if driver_name in files:
+                    chromedriver_path = os.path.join(root, driver_name)
                     break
-            if chromedriver_path:
-                break
+                    
+            if not chromedriver_path:
+                raise Exception("ChromeDriver binary not found in downloaded package")
                 
-        if not chromedriver_path:
-            raise Exception("ChromeDriver binary not found in downloaded package")
+            # Make it executable
+            os.chmod(chromedriver_path, 0o755)
             
-        # Make it executable
-        os.chmod(chromedriver_path, 0o755)
+            install_dir = os.path.join(temp_dir, "install")
+            os.mkdir(install_dir)
+            os.replace(chromedriver_path, os.path.join(install_dir, driver_name))
+            shutil.rmtree(driver_dir, ignore_errors=True)
+            os.replace(install_dir, driver_dir)
         
-        return chromedriver_path
+        return milestone["version"]
         
     except Exception as e:
         logger.error(f"Failed to download ChromeDriver: {str(e)}")
@@ -157,6 +240,9 @@ def download_chromedriver(system, arch):
 
 def setup_driver(headless=True):
     """Setup undetected-chromedriver with appropriate options"""
+    import undetected_chromedriver as uc
+    from selenium.common.exceptions import WebDriverException
+
     try:
         logger.info("Setting up Chrome options...")
         options = uc.ChromeOptions()
@@ -180,12 +266,21 @@ def setup_driver(headless=True):
         # Set realistic user agent
         options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
         
+        # The ChromeDriver comes from the local cache, undetected_chromedriver only downloads one when that fails
+        chrome_version = get_chrome_version()
+        try:
+            driver_path = get_chromedriver(*get_system_info(), chrome_version)
+        except Exception as e:
+            logger.warning(f"No cached ChromeDriver, letting undetected_chromedriver download it: {str(e)}")
+            driver_path = None
+        
         logger.info("Creating Chrome driver...")
         driver = uc.Chrome(
             options=options,
             headless=headless,
             use_subprocess=True,
-            version_main=131,
+            version_main=chrome_version,
+            driver_executable_path=driver_path,
             suppress_welcome=True
         )
         
@@ -204,7 +299,8 @@ def setup_driver(headless=True):
         
         # Set timeouts
         driver.set_page_load_timeout(30)  # Reduced timeout to fail faster
-        driver.implicitly_wait(10)  # Reduced implicit wait
+        # No implicit wait, a lookup that misses would stall for the whole wait. Every wait is an explicit WebDriverWait.
+        driver.implicitly_wait(0)
         
         logger.info("Chrome driver setup complete")
         return driver
@@ -218,6 +314,11 @@ def setup_driver(headless=True):
 
 def login_to_garmin(driver, email, password):
     """Log in to Garmin Connect"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+
     try:
         logger.info("Attempting to log in to Garmin Connect...")
         
@@ -266,7 +367,9 @@ def login_to_garmin(driver, email, password):
         time.sleep(random.uniform(0.5, 1.5))
         
         logger.info("Entering password...")
-        password_field = driver.find_element(By.ID, "password")
+        password_field = WebDriverWait(driver, 10).until(
+            EC.element_to_be_clickable((By.ID, "password"))
+        )
         password_field.clear()
         for char in password:
             password_field.send_keys(char)
@@ -275,7 +378,9 @@ def login_to_garmin(driver, email, password):
         time.sleep(random.uniform(0.5, 1.5))
         
         logger.info("Clicking sign in button...")
-        sign_in_button = driver.find_element(By.ID, "login-btn-signin")
+        sign_in_button = WebDriverWait(driver, 10).until(
+            EC.element_to_be_clickable((By.ID, "login-btn-signin"))
+        )
         sign_in_button.click()
         
         logger.info("Waiting for login to complete...")
@@ -300,8 +405,33 @@ def login_to_garmin(driver, email, password):
             logger.error(f"Failed to capture debug info: {str(screenshot_error)}")
         return False
 
+# Finds every Join button and the id and name of its challenge card in one round trip to the browser
+EXTRACT_CHALLENGE_CARDS_SCRIPT = """
+    const cards = [];
+    for (const button of document.querySelectorAll('button')) {
+        if (button.textContent.trim() !== 'Join') continue;
+        const card = button.closest('[class*="BadgeChallengeCard"], [data-testid="badge-challenge-card"]');
+        const nameElement = card && card.querySelector('[class*="badgeName"], [class*="title"], [class*="name"]');
+        const link = card && card.querySelector('a[href*="challenge"]');
+        cards.push({
+            button: button,
+            id: link ? link.getAttribute('href').split('/').pop() : null,
+            name: nameElement ? nameElement.textContent.trim() : null
+        });
+    }
+    return cards;
+"""
+
+COUNT_CHALLENGE_CARDS_SCRIPT = """
+    return document.querySelectorAll('[class*="BadgeChallengeCard"], [data-testid="badge-challenge-card"]').length;
+"""
+
 def wait_for_challenges_page(driver):
     """Wait for the challenges page to load"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     try:
         logger.info("Waiting for challenges page to load...")
         
@@ -314,16 +444,37 @@ def wait_for_challenges_page(driver):
             )
         )
         
-        # Wait a bit more for all dynamic content
-        time.sleep(5)
+        # The cards are rendered in batches, wait until their number stops changing
+        card_counts = []
+        def card_count_is_stable(driver):
+            card_counts.append(driver.execute_script(COUNT_CHALLENGE_CARDS_SCRIPT))
+            return len(card_counts) >= 3 and card_counts[-1] == card_counts[-2] == card_counts[-3]
+        try:
+            WebDriverWait(driver, 10, poll_frequency=0.25).until(card_count_is_stable)
+        except Exception:
+            logger.info("Challenge cards were still loading, using the cards found so far")
         return True
         
     except Exception as e:
         logger.error(f"Failed to load challenges page: {str(e)}")
         return False
 
+def join_button_has_changed(button):
+    """Wait condition: the Join button was replaced, disabled or renamed after the click"""
+    from selenium.common.exceptions import StaleElementReferenceException
+
+    def condition(driver):
+        try:
+            return not button.is_enabled() or button.text.strip() != "Join"
+        except StaleElementReferenceException:
+            return True
+    return condition
+
 def join_challenges(driver):
     """Join all available challenges"""
+    from selenium.webdriver import ActionChains
+    from selenium.webdriver.support.ui import WebDriverWait
+
     try:
         print("\n=== Navigating to Challenges Page ===")
         driver.get("https://connect.garmin.com/modern/challenge")
@@ -332,12 +483,9 @@ def join_challenges(driver):
             logger.error("Could not load challenges page")
             return
         
-        # Wait a bit more for dynamic content
-        time.sleep(5)
-        
-        # Find all Join buttons
-        join_buttons = driver.find_elements(By.XPATH, "//button[text()='Join']")
-        total_challenges = len(join_buttons)
+        # Find all Join buttons with the name of their challenge
+        challenge_cards = driver.execute_script(EXTRACT_CHALLENGE_CARDS_SCRIPT)
+        total_challenges = len(challenge_cards)
         
         if total_challenges == 0:
             print("\n✨ No new challenges found to join!")
@@ -346,48 +494,18 @@ def join_challenges(driver):
         print(f"\n=== Found {total_challenges} Challenge{'s' if total_challenges > 1 else ''} to Join ===")
         
         challenges_joined = 0
-        for button in join_buttons:
+        for card in challenge_cards:
+            button = card["button"]
+            challenge_name = card["name"] or "Unknown Challenge"
             try:
-                # Get the challenge name from the card using a more robust selector
-                try:
-                    # Find the parent card element
-                    challenge_card = button.find_element(By.XPATH, "./ancestor::div[contains(@class, 'BadgeChallengeCard')]")
-                    
-                    # Try multiple selectors for the name
-                    name_selectors = [
-                        ".//div[contains(@class, 'badgeName')]",  # Generic class name
-                        ".//div[contains(@class, 'BadgeChallengeCard') and contains(@class, 'badgeName')]",  # More specific
-                        ".//div[contains(@class, 'title')]",  # Fallback to generic title
-                        ".//div[contains(@class, 'name')]",  # Another fallback
-                    ]
-                    
-                    challenge_name = None
-                    for selector in name_selectors:
-                        try:
-                            name_elem = challenge_card.find_element(By.XPATH, selector)
-                            challenge_name = name_elem.text
-                            if challenge_name:
-                                break
-                        except:
-                            continue
-                    
-                    if not challenge_name:
-                        challenge_name = "Unknown Challenge"
-                        
-                except Exception as e:
-                    logger.debug(f"Could not get challenge details: {str(e)}")
-                    challenge_name = "Unknown Challenge"
-                
                 print(f"\n🎯 Joining challenge ({challenges_joined + 1}/{total_challenges}): {challenge_name}")
-                
-                # Scroll the button into view with offset to avoid header overlap
-                driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", button)
-                time.sleep(1)  # Wait for any animations
+                if card["id"]:
+                    logger.debug(f"Challenge id: {card['id']}")
                 
                 # Try multiple click methods
                 try:
-                    # Try JavaScript click first
-                    driver.execute_script("arguments[0].click();", button)
+                    # Try JavaScript click first, scrolled into view with offset to avoid header overlap
+                    driver.execute_script("arguments[0].scrollIntoView({block: 'center'}); arguments[0].click();", button)
                 except:
                     try:
                         # Try regular click
@@ -397,9 +515,10 @@ def join_challenges(driver):
                         actions = ActionChains(driver)
                         actions.move_to_element(button).click().perform()
                 
+                # Joined once the button changes, instead of waiting a fixed time
+                WebDriverWait(driver, 10, poll_frequency=0.2).until(join_button_has_changed(button))
                 challenges_joined += 1
                 print(f"✅ Successfully joined: {challenge_name}")
-                time.sleep(2)  # Wait between joins
                 
             except Exception as e:
                 print(f"❌ Failed to join: {challenge_name}")
@@ -419,10 +538,115 @@ def join_challenges(driver):
         logger.error(f"Error in join_challenges: {str(e)}")
         return 0
 
+def parse_arguments():
+    """Parse the command line options"""
+    parser = argparse.ArgumentParser(description="Join the available Garmin Connect badge challenges")
+    parser.add_argument("--list", action="store_true", help="only list the available challenges, don't join them")
+    parser.add_argument("--type", action="append", default=[], help="only challenges whose name or category contains TYPE, e.g. run or steps (can be repeated)")
+    parser.add_argument("--from", dest="from_date", type=date.fromisoformat, help="only challenges that end on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="to_date", type=date.fromisoformat, help="only challenges that start on or before this date (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=4, help="number of challenges joined at the same time (default 4)")
+    parser.add_argument("--garth-dir", default=os.getenv("GARTH_DIR", "~/.garth"), help="folder of the Garmin Connect session of garmin-badges-updater.py (default ~/.garth)")
+    parser.add_argument("--selenium", action="store_true", help="join the challenges in a browser instead of through the Garmin Connect API")
+    return parser.parse_args()
+
+def login_to_garmin_api(garth_dir, email, password):
+    """Resume the garth session of the updater, or log in with the credentials from .env"""
+    import garth
+
+    garth_dir = os.path.expanduser(garth_dir)
+    try:
+        garth.resume(garth_dir)
+        logger.info(f"Using the Garmin Connect session in {garth_dir}")
+    except Exception:
+        if not email or not password:
+            raise Exception(f"No Garmin Connect session in {garth_dir} and no credentials in .env file")
+        logger.info("Logging in to Garmin Connect...")
+        garth.login(email, password)
+        garth.save(garth_dir)
+    return garth.client
+
+def parse_challenge_date(value):
+    """Date of a challenge, Garmin sends e.g. 2024-11-01T00:00:00.0"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value)[:10]).date()
+    except ValueError:
+        return None
+
+def get_challenge_name(challenge):
+    return challenge.get("badgeChallengeName") or challenge.get("challengeName") or "Unknown Challenge"
+
+def filter_challenges(challenges, types, from_date, to_date):
+    """Challenges that aren't joined yet and match the type and date filters"""
+    selected = []
+    for challenge in challenges:
+        if challenge.get("userJoined"):
+            continue
+        if types:
+            text = f"{get_challenge_name(challenge)} {challenge.get('challengeCategoryId', '')} {challenge.get('challengeCategoryKey', '')}".lower()
+            if not any(challenge_type.lower() in text for challenge_type in types):
+                continue
+        start_date = parse_challenge_date(challenge.get("startDate"))
+        end_date = parse_challenge_date(challenge.get("endDate"))
+        if from_date and end_date and end_date < from_date:
+            continue
+        if to_date and start_date and start_date > to_date:
+            continue
+        selected.append(challenge)
+    return selected
+
+def fetch_available_challenges(client):
+    """Available badge challenges of the user"""
+    return client.connectapi(AVAILABLE_CHALLENGES_PATH) or []
+
+def join_challenge(client, challenge):
+    """Join one challenge, returns the challenge and an error or None"""
+    try:
+        client.request(JOIN_CHALLENGE_METHOD, "connectapi", JOIN_CHALLENGE_PATH.format(uuid=challenge["uuid"]), api=True)
+        return challenge, None
+    except Exception as e:
+        return challenge, e
+
+def join_challenges_with_api(client, args):
+    """List and join the available challenges through the Garmin Connect API, returns the number joined"""
+    challenges = filter_challenges(fetch_available_challenges(client), args.type, args.from_date, args.to_date)
+    if not challenges:
+        print("\n✨ No new challenges found to join!")
+        return 0
+
+    print(f"\n=== Found {len(challenges)} Challenge{'s' if len(challenges) > 1 else ''} to Join ===")
+    for challenge in challenges:
+        start_date = parse_challenge_date(challenge.get("startDate"))
+        end_date = parse_challenge_date(challenge.get("endDate"))
+        print(f"🎯 {get_challenge_name(challenge)} ({start_date or '?'} - {end_date or '?'})")
+    if args.list:
+        return 0
+
+    challenges_joined = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        for challenge, error in executor.map(lambda challenge: join_challenge(client, challenge), challenges):
+            if error:
+                print(f"❌ Failed to join: {get_challenge_name(challenge)}")
+                logger.error(f"Error details: {str(error)}")
+            else:
+                challenges_joined += 1
+                print(f"✅ Successfully joined: {get_challenge_name(challenge)}")
+
+    print("\n=== Summary ===")
+    print(f"✨ Successfully joined {challenges_joined} out of {len(challenges)} challenge{'s' if len(challenges) > 1 else ''}")
+    if challenges_joined < len(challenges):
+        print(f"⚠️  Failed to join {len(challenges) - challenges_joined} challenge{'s' if (len(challenges) - challenges_joined) > 1 else ''}")
+    if not challenges_joined:
+        raise Exception("None of the challenges could be joined through the API")
+    return challenges_joined
+
 def main():
     """Main function"""
     display = None
     try:
+        args = parse_arguments()
         print("\n=== Starting Garmin Challenge Joiner ===")
         
         # Load environment variables
@@ -430,11 +654,25 @@ def main():
         email = os.getenv("GARMIN_CONNECT_USERNAME")
         password = os.getenv("GARMIN_CONNECT_PASSWORD")
         
+        if not args.selenium:
+            # The API needs no browser, the browser is only started when the API can't be used
+            try:
+                client = login_to_garmin_api(args.garth_dir, email, password)
+                join_challenges_with_api(client, args)
+                return
+            except Exception as e:
+                logger.error(f"Garmin Connect API failed: {str(e)}")
+                if args.list or args.type or args.from_date or args.to_date:
+                    print("❌ Listing and filtering challenges needs the Garmin Connect API")
+                    return
+                print("🔄 Falling back to the browser...")
+        
         if not email or not password:
             print("❌ Missing Garmin Connect credentials in .env file")
             return
         
         print("🔄 Starting virtual display...")
+        from xvfbwrapper import Xvfb
         display = Xvfb(width=1920, height=1080, colordepth=24)
         display.start()
         
@@ -3,6 +3,7 @@
 # Configuration
 SCRIPT_PATH="/root/sourcecontrol/script-garmin-badges-sync/garmin-badges-updater.py"
 LOG_FILE="/var/log/garmin-badges-sync.log"
+METRICS_FILE="/var/log/garmin-badges-sync-metrics.json"
 DISCORD_WEBHOOK_URL="https://discord.com/api/webhooks/1398061429822853150/2pE4MNTeCEcVXWf5D9ZN9SpofJTOYIc2yFsc6cYRngx1nMKUe_Rga2afGwJ1lZgrYNh1"
 
 # Run the Python script
@@ -10,7 +11,7 @@ echo "----------------------------------------" >> "$LOG_FILE"
 echo "Starting sync at $(date)" >> "$LOG_FILE"
 
 # Run with system python3
-/usr/bin/python3 "$SCRIPT_PATH" >> "$LOG_FILE" 2>&1
+/usr/bin/python3 "$SCRIPT_PATH" --metrics-json="$METRICS_FILE" >> "$LOG_FILE" 2>&1
 EXIT_CODE=$?
 
 # Checks